@@ -1,3 +1,7 @@
+import functools
+import threading
+import uuid
+from concurrent.futures import Future
 from datetime import datetime
 
 import dash
@@ -6,8 +10,8 @@ import dash_html_components as html
 import dash_table as dt
 import numpy as np
 import pandas as pd
-from dash.dependencies import Input, Output
-from src import config, data, plot, model
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from src import cache, config, data, jobs, kpi, live, metrics, plot, model
 
 # Create app
 app = dash.Dash(
@@ -16,160 +20,347 @@ app = dash.Dash(
 )
 server = app.server
 
+# timings of the stages of each request in its Server-Timing header, metrics on /metrics
+metrics.init_app(server)
+
 app.config.suppress_callback_exceptions = True
 
-# load data
-df = pd.read_csv(
-    config.get_processed_filename(config.DATA_FILES['order'])
-)
-df[config.COLUMN_DATE] = df[config.COLUMN_DATE].apply(pd.to_datetime)
+# Forecasts of the filtered sales are fitted in the background, the sales chart shows them once available
+forecasts = model.ForecastService()
+
+# Heavy panels are computed in the background, their callbacks return at once and the page polls until done
+panels = jobs.JobService()
+
+
+def forecast_sales(snapshot, signature, dff, unfiltered):
+    store, batch_forecasts = snapshot.store, snapshot.batch_forecasts
+    start_date, end_date, payment_type, product_category, state = signature
+
+    # one state and one category over the whole dataset are looked up in the batch forecasts, precomputed with
+    # python -m src.model --batch
+    if (batch_forecasts is not None and len(state) == 1 and len(product_category) == 1
+            and list(payment_type) == store.values('payment_type')
+            and start_date <= str(store.min_date()) and end_date >= str(store.max_date())
+            and (state[0], product_category[0]) in batch_forecasts.index):
+        predictions = batch_forecasts.loc[(state[0], product_category[0])].reset_index(drop=True)
+        return True, None if predictions['forecast'].isna().all() else predictions
+
+    # the forecast of the whole dataset is also persisted on disk for the next start
+    return forecasts.get((snapshot.version, signature), dff['order_purchase_timestamp'], dff['payment_value'],
+                         persist=unfiltered)
+
+
+def default_signature(store):
+    return data.filter_signature(str(store.min_date()), str(store.max_date()), store.values('payment_type'),
+                                 store.values('product_category_name'), store.values('state_name'))
+
+
+def warm(snapshot):
+    # entries of the previous snapshot would keep its memory maps open, and with them the files of the directories
+    # replaced by the new version
+    for function in _snapshot_caches.values():
+        function.cache_clear()
+
+    # compute the default view of a new version before it is served, the first page load of every user hits it
+    signature = default_signature(snapshot.store)
+    for callback in _cached_callbacks:
+        callback.compute(snapshot, signature)
+
+
+# The callbacks below fire together on every filter change with the same inputs: filter once per
+# signature and let every panel read the shared result. Results are cached per snapshot, a new version of the
+# data never hits the entries of the previous one.
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(function, *args):
+    '''call of a memoized function, made by one thread at a time per arguments: concurrent calls with the same
+    arguments wait for the first one and share its result, calls with other arguments run in parallel.
+    '''
+    key = (function, args)
+    while True:
+        with _flights_lock:
+            future = _flights.get(key)
+            owner = future is None
+            if owner:
+                future = _flights[key] = Future()
+
+        if owner:
+            break
+
+        try:
+            return future.result()
+        except jobs.Cancelled:
+            # the first call was made by a cancelled job, compute it again
+            continue
+
+    try:
+        result = function(*args)
+    except BaseException as exception:
+        future.set_exception(exception)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _flights_lock:
+            del _flights[key]
+
+
+@functools.lru_cache(maxsize=32)
+def _filter_rows(snapshot, signature):
+    return snapshot.store.rows(*signature)
+
+
+@functools.lru_cache(maxsize=32)
+def _filter_cells(snapshot, signature):
+    return snapshot.cube.cells(*signature)
+
+
+@functools.lru_cache(maxsize=32)
+def _prefix_sums(snapshot, dimensions):
+    # every day of the data, the date range of a selection is then a lookup
+    store = snapshot.store
+    cells = snapshot.cube.cells(str(store.min_date()), str(store.max_date()), *dimensions)
+    return snapshot.cube.prefix_sums(cells)
+
+
+def prefix_sums(snapshot, signature):
+    return single_flight(_prefix_sums, snapshot, signature[2:])
+
+
+def filtered_rows(snapshot, signature):
+    return single_flight(_filter_rows, snapshot, signature)
+
+
+def filtered_cells(snapshot, signature):
+    return single_flight(_filter_cells, snapshot, signature)
+
+
+_snapshot_caches = {
+    'filter_rows': _filter_rows,
+    'filter_cells': _filter_cells,
+    'prefix_sums': _prefix_sums,
+}
+metrics.lru_cache_collector(_snapshot_caches)
+
+
+# Outputs of the callbacks are cached per data version and filter signature, in this process and optionally in a
+# store shared by every worker (config.OUTPUT_CACHE_SHARED). Toggling back to a selection already seen, by any
+# user, skips the callback.
+outputs = cache.make_cache()
+_cached_callbacks = []
+
+
+def cached_output(cacheable=None, background=False):
+    '''cache the output of a function of the snapshot and the filter signature, called back with the five filters.
+
+    Extra inputs of the callback are passed to the function but are not part of the key. Outputs for which
+    cacheable returns False are not kept.
+
+    Background outputs are called back with the ticks of the poll of their panel and the session of the page as
+    well, and give the output with whether the poll is done: when config.BACKGROUND_PANELS is set, outputs not cached
+    yet are computed as jobs and no update is sent until their job is done.
+    '''
+    def decorator(function):
+        name = function.__name__
+
+        def compute(snapshot, signature, *args):
+            return outputs.get_or_compute((name, snapshot.version, signature),
+                                          lambda: function(snapshot, signature, *args), cacheable)
+
+        def poll(snapshot, signature, n_intervals, session):
+            if not config.BACKGROUND_PANELS:
+                return compute(snapshot, signature), True
+
+            def job():
+                with metrics.stage('job', name):
+                    return compute(snapshot, signature)
+
+            key = (name, snapshot.version, signature)
+            done, output = outputs.get(key)
+            if done:
+                panels.release(session, name)
+            else:
+                done, output = panels.get(session, name, key, job)
+
+            return output if done else dash.no_update, done
+
+        @functools.wraps(function)
+        def callback(start_date, end_date, payment_type, product_category, state, *args):
+            signature = data.filter_signature(start_date, end_date, payment_type, product_category, state)
+            with metrics.stage('callback', name):
+                if background:
+                    return poll(dataset.snapshot, signature, *args)
+                return compute(dataset.snapshot, signature, *args)
+
+        callback.compute = compute
+        _cached_callbacks.append(callback)
+        return callback
+
+    return decorator
+
+
+# load data, memory-mapped when consolidate_dataset wrote the binary store and cube. New versions published by
+# data.save_dataset or queued in config.DIR_INGEST are loaded and warmed up in the background, then swapped in
+# without restart.
+dataset = live.LiveDataset(warm=warm)
 
-# Compute the forecast only once
-dff = df[df['order_status'].isin(config.ORDER_STATUS_CONSO)]
-dff = dff.groupby(pd.Grouper(key='order_purchase_timestamp', freq='1D'))['payment_value'].sum().reset_index()
-predictions = model.predict(dff['order_purchase_timestamp'], dff['payment_value'], look_ahead=15)
 
 # -------------------------------------------------------------------------------
 # layout
 # -------------------------------------------------------------------------------
-app.layout = html.Div([
+def background_panel(name, children):
+    # container of a panel whose output is computed in the background and the poll of its job, dimmed while the job
+    # runs (assets/panels.js). Panels computed within their callback show a spinner instead.
+    if not config.BACKGROUND_PANELS:
+        children = [dcc.Loading(type='graph', children=children)]
+
+    return html.Div(
+        children + [dcc.Interval(id=f'{name}_poll', interval=config.JOB_POLL_INTERVAL, disabled=True)],
+        id=f'{name}_panel',
+        className='graph_container',
+    )
 
-    html.Div(id='output-clientside'),
 
-    # title
-    html.Div([
-        html.H1('Sales overview')
-    ]),
+def serve_layout():
+    # built on every page load so that the filters cover the current version of the data
+    store = dataset.snapshot.store
 
-    # main container
-    html.Div([
+    return html.Div([
 
-        # left panel
-        html.Div([
-            # date filter
-            html.P(
-                'Filter by order date',
-                className='control_label'
-            ),
-            dcc.DatePickerRange(
-                id='date_slider',
-                display_format='D/M/Y',
-                min_date_allowed=data.min_date(df),
-                max_date_allowed=data.max_date(df),
-                initial_visible_month=data.max_date(df),
-                start_date=data.min_date(df),
-                end_date=data.max_date(df),
-                className='dcc_control'
-            ),
-
-            # payment type
-            html.P(
-                'Payment type',
-                className='control_label'
-            ),
-            dcc.Dropdown(
-                id='payment_type',
-                options=data.values_to_options(data.payment_types(df)),
-                multi=True,
-                value=data.payment_types(df),
-                className='dcc_control',
-            ),
-
-            # states
-            html.P(
-                'State',
-                className='control_label'
-            ),
-            dcc.Dropdown(
-                id='state',
-                options=data.values_to_options(data.states(df)),
-                multi=True,
-                value=data.states(df),
-                className='dcc_control',
-            ),
-
-            # product category
-            html.P(
-                'Product category',
-                className='control_label'
-            ),
-            dcc.Dropdown(
-                id='product_category',
-                options=data.values_to_options(data.product_categories(df)),
-                multi=True,
-                value=data.product_categories(df),
-                className='dcc_control',
-            ),
+        html.Div(id='output-clientside'),
 
-        ],
-            className='filters_container'),
+        # identifies the page to the background jobs of its panels
+        dcc.Store(id='session', data=uuid.uuid4().hex),
+
+        # title
+        html.Div([
+            html.H1('Sales overview')
+        ]),
 
-        # right panel
+        # main container
         html.Div([
 
-            # KPI container
+            # left panel
             html.Div([
-                # YTD sales
-                html.Div(
-                    [html.H2(id='kpi_sales_value'), html.H5('Revenue')],
-                    id='kpi_sales', className='mini_container',
+                # date filter
+                html.P(
+                    'Filter by order date',
+                    className='control_label'
+                ),
+                dcc.DatePickerRange(
+                    id='date_slider',
+                    display_format='D/M/Y',
+                    min_date_allowed=store.min_date(),
+                    max_date_allowed=store.max_date(),
+                    initial_visible_month=store.max_date(),
+                    start_date=store.min_date(),
+                    end_date=store.max_date(),
+                    className='dcc_control'
+                ),
+
+                # payment type
+                html.P(
+                    'Payment type',
+                    className='control_label'
+                ),
+                dcc.Dropdown(
+                    id='payment_type',
+                    options=data.values_to_options(store.values('payment_type')),
+                    multi=True,
+                    value=store.values('payment_type'),
+                    className='dcc_control',
+                ),
+
+                # states
+                html.P(
+                    'State',
+                    className='control_label'
                 ),
-                # Average order value
-                html.Div(
-                    [html.H2(id='kpi_aov_value'), html.H5('Average order value')],
-                    id='kpi_aov', className='mini_container',
+                dcc.Dropdown(
+                    id='state',
+                    options=data.values_to_options(store.values('state_name')),
+                    multi=True,
+                    value=store.values('state_name'),
+                    className='dcc_control',
                 ),
-                # Abandonment rate
-                html.Div(
-                    [html.H2(id='kpi_abandonment_value'), html.H5('Abandonment rate')],
-                    id='kpi_abandonment', className='mini_container',
+
+                # product category
+                html.P(
+                    'Product category',
+                    className='control_label'
                 ),
-                # Customer lifetime value
-                html.Div(
-                    [html.H2(id='kpi_order_statisfaction'), html.H5('Orders satisfaction')],
-                    id='kpi_order_satisfaction', className='mini_container',
+                dcc.Dropdown(
+                    id='product_category',
+                    options=data.values_to_options(store.values('product_category_name')),
+                    multi=True,
+                    value=store.values('product_category_name'),
+                    className='dcc_control',
                 ),
+
             ],
-                className='kpi_container'),
-
-            dcc.Loading(
-                id='loading',
-                type='graph',
-                children=[
-                    # timeserie
-                    html.Div([
-                        html.H3('Sales'),
-                        dcc.Graph(id='time_serie')
-                    ],
-                        className='graph_container'),
-
-                    # sellers
-                    html.Div([
-                        html.H3('Sellers'),
-                        dcc.Graph(id='sellers')
-                    ],
-                        className='graph_container'),
-
-                    # states
-                    html.Div([
-                        dcc.Graph(id='states')
-                    ],
-                        className='graph_container'),
-
-                    # products
-                    html.Div([
-                        html.H3('Product categories'),
-                        html.Div(id='product_table'),
-                    ],
-                        className='graph_container'),
-                ])
+                className='filters_container'),
+
+            # right panel
+            html.Div([
+
+                # KPI container, one box per registered KPI
+                html.Div([
+                    html.Div(
+                        [html.H2(id=f'kpi_{name}_value'), html.H5(indicator.label)],
+                        id=f'kpi_{name}', className='mini_container',
+                    )
+                    for name, indicator in kpi.KPIS.items()
+                ],
+                    className='kpi_container'),
+
+                # timeserie
+                dcc.Loading(
+                    id='loading',
+                    type='graph',
+                    children=[
+                        html.Div([
+                            html.H3('Sales'),
+                            dcc.Graph(id='time_serie'),
+                            dcc.Store(id='time_serie_template', data=plot.sales_timeserie_template()),
+                            dcc.Store(id='time_serie_data'),
+                            dcc.Interval(id='forecast_poll', interval=5000),
+                        ],
+                            className='graph_container'),
+                    ]),
+
+                # sellers
+                background_panel('sellers', [
+                    html.H3('Sellers'),
+                    dcc.Graph(id='sellers'),
+                    dcc.Store(id='sellers_template', data=plot.sellers_template()),
+                    dcc.Store(id='sellers_data'),
+                ]),
+
+                # states
+                background_panel('states', [
+                    dcc.Graph(id='states'),
+                    dcc.Store(id='states_template', data=plot.sales_map_template()),
+                    dcc.Store(id='states_data'),
+                ]),
+
+                # products
+                background_panel('product_table', [
+                    html.H3('Product categories'),
+                    html.Div(id='product_table'),
+                ]),
+            ],
+                className='right_panel')
+
         ],
-            className='right_panel')
+            style={'display': 'flex', 'flex-direction': 'row'}),
 
-    ],
-        style={'display': 'flex', 'flex-direction': 'row'}),
+    ])
 
-])
+
+app.layout = serve_layout
 
 
 # -------------------------------------------------------------------------------
@@ -178,39 +369,7 @@ app.layout = html.Div([
 
 # KPIs
 @app.callback(
-    Output('kpi_sales_value', 'children'),
-    [
-        Input('date_slider', 'start_date'),
-        Input('date_slider', 'end_date'),
-        Input('payment_type', 'value'),
-        Input('product_category', 'value'),
-        Input('state', 'value'),
-    ],
-)
-def update_kpi_revenue(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    return f'R$ {data.revenue(dff):,.0f}'
-
-
-@app.callback(
-    Output('kpi_aov_value', 'children'),
-    [
-        Input('date_slider', 'start_date'),
-        Input('date_slider', 'end_date'),
-        Input('payment_type', 'value'),
-        Input('product_category', 'value'),
-        Input('state', 'value'),
-    ],
-)
-def update_kpi_aov(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    aov = data.aov(dff)
-
-    return f'R$ {aov:.0f}'
-
-
-@app.callback(
-    Output('kpi_abandonment_value', 'children'),
+    [Output(f'kpi_{name}_value', 'children') for name in kpi.KPIS],
     [
         Input('date_slider', 'start_date'),
         Input('date_slider', 'end_date'),
@@ -219,103 +378,86 @@ def update_kpi_aov(start_date, end_date, payment_type, product_category, state):
         Input('state', 'value'),
     ],
 )
-def update_kpi_abandonment(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    abandonment_rate = data.abandonment_rate(dff)
-
-    return f'{abandonment_rate:.2f}%'
+@cached_output()
+def update_kpis(snapshot, signature):
+    start_day, end_day = data.to_epoch_day(list(signature[:2]))
+    values = kpi.compute(snapshot.store, filtered_rows(snapshot, signature), prefix_sums(snapshot, signature),
+                         start_day, end_day)
+    return kpi.format_values(values)
 
 
 @app.callback(
-    Output('kpi_order_statisfaction', 'children'),
+    [Output('time_serie_data', 'data'), Output('forecast_poll', 'disabled')],
     [
         Input('date_slider', 'start_date'),
         Input('date_slider', 'end_date'),
         Input('payment_type', 'value'),
         Input('product_category', 'value'),
         Input('state', 'value'),
+        Input('forecast_poll', 'n_intervals'),
     ],
 )
-def update_kpi_order_statisfaction(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    order_satisfaction = data.order_satisfaction(dff)
-
-    return f'{order_satisfaction:.0f}%'
+@cached_output(cacheable=lambda output: output[1])
+def make_timeserie(snapshot, signature, n_intervals=None):
+    cells = filtered_cells(snapshot, signature)
+    dff = snapshot.cube.daily_sales(cells)
 
+    # poll until the forecast of this selection is fitted
+    forecast_done, predictions = forecast_sales(snapshot, signature, dff, len(cells) == len(snapshot.cube))
+    make_predictions = predictions is not None
 
-@app.callback(
-    Output('time_serie', 'figure'),
-    [
-        Input('date_slider', 'start_date'),
-        Input('date_slider', 'end_date'),
-        Input('payment_type', 'value'),
-        Input('product_category', 'value'),
-        Input('state', 'value'),
-    ],
-)
-def make_timeserie(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    
-    if dff.equals(df):
-        make_predictions = True
-    else:
-        make_predictions = False
-    
-    dff = dff[dff['order_status'].isin(config.ORDER_STATUS_CONSO)]
-    dff = dff.groupby(pd.Grouper(key='order_purchase_timestamp', freq='1D')).agg({
-        'payment_value': 'sum',
-        'order_id': 'nunique'
-    }).reset_index()
+    # moving mean over the days of the chart from the prefix sums instead of a rolling window
+    dff_rolling_mean = pd.DataFrame(columns=['order_purchase_timestamp', 'payment_value'])
+    if len(dff):
+        start_day, end_day = data.to_epoch_day(dff['order_purchase_timestamp'].iloc[[0, -1]])
+        dff_rolling_mean = prefix_sums(snapshot, signature).rolling_mean('payment_value', 30, start_day, end_day)
 
-    fig = plot.sales_timeserie(dff, predictions, make_predictions)
+    traces = plot.sales_timeserie_data(dff, predictions, make_predictions, dff_rolling_mean)
 
-    return fig
+    return traces, forecast_done
 
 
 @app.callback(
-    Output('states', 'figure'),
+    [Output('states_data', 'data'), Output('states_poll', 'disabled')],
     [
         Input('date_slider', 'start_date'),
         Input('date_slider', 'end_date'),
         Input('payment_type', 'value'),
         Input('product_category', 'value'),
         Input('state', 'value'),
+        Input('states_poll', 'n_intervals'),
     ],
+    [State('session', 'data')],
 )
-def make_states(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    dff_map = dff.groupby(['customer_state', 'state_name', 'lat', 'long'])['payment_value'].sum().reset_index()
+@cached_output(background=True)
+def make_states(snapshot, signature):
+    cells = filtered_cells(snapshot, signature)
+    jobs.checkpoint()
+    dff_map, dff_time = snapshot.cube.state_sales(cells)
     dff_map['text'] = dff_map['state_name'] + ': ' + dff_map['payment_value'].apply(lambda x: f'R$ {x:,.0f}')
 
-    dff_time = dff.groupby(['customer_state', 'state_name', pd.Grouper(key='order_purchase_timestamp', freq='1M')])[
-        'payment_value'].sum().reset_index()
+    traces = plot.sales_map_data(dff_map, dff_time)
 
-    fig = plot.sales_map(dff_map, dff_time)
-
-    return fig
+    return traces
 
 
 @app.callback(
-    Output('product_table', 'children'),
+    [Output('product_table', 'children'), Output('product_table_poll', 'disabled')],
     [
         Input('date_slider', 'start_date'),
         Input('date_slider', 'end_date'),
         Input('payment_type', 'value'),
         Input('product_category', 'value'),
         Input('state', 'value'),
+        Input('product_table_poll', 'n_intervals'),
     ],
+    [State('session', 'data')],
 )
-def make_product_categories(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    dff = dff[dff['order_status'].isin(config.ORDER_STATUS_CONSO)]
-
-    dff = dff.groupby('product_category_name').agg(
-        total_order_value=('payment_value', 'sum'),
-        mean_order_value=('payment_value', 'mean'),
-        n_customer=('customer_id', 'nunique'),
-        n_order=('order_id', 'nunique'),
-        n_seller=('seller_id', 'nunique'),
-    ).reset_index().sort_values('total_order_value', ascending=False)
+@cached_output(background=True)
+def make_product_categories(snapshot, signature):
+    cells = filtered_cells(snapshot, signature)
+    jobs.checkpoint()
+    dff = snapshot.cube.product_categories(cells).sort_values('total_order_value', ascending=False)
 
     dff['percentage_total'] = 100 * dff['total_order_value'] / dff['total_order_value'].sum()
 
@@ -345,33 +487,55 @@ def make_product_categories(start_date, end_date, payment_type, product_category
 
 
 @app.callback(
-    Output('sellers', 'figure'),
+    [Output('sellers_data', 'data'), Output('sellers_poll', 'disabled')],
     [
         Input('date_slider', 'start_date'),
         Input('date_slider', 'end_date'),
         Input('payment_type', 'value'),
         Input('product_category', 'value'),
         Input('state', 'value'),
+        Input('sellers_poll', 'n_intervals'),
     ],
+    [State('session', 'data')],
 )
-def make_sellers(start_date, end_date, payment_type, product_category, state):
-    dff = data.filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state=state)
-    dff = dff[dff['order_status'].isin(config.ORDER_STATUS_CONSO)]
+@cached_output(background=True)
+def make_sellers(snapshot, signature):
+    df_seller_rank, df_seller_month = snapshot.store.seller_sales(filtered_rows(snapshot, signature))
+    jobs.checkpoint()
+
+    traces = plot.sellers_data(df_seller_rank, df_seller_month)
+
+    return traces
 
-    df_seller_rank = dff.groupby('seller_id')['payment_value'].sum().reset_index().sort_values('payment_value',
-                                                                                               ascending=False).head(10)
 
-    df_seller_month = dff.loc[:, ['order_purchase_timestamp', 'seller_id', 'payment_value']]
-    df_seller_month['month_no'] = df_seller_month['order_purchase_timestamp'].dt.month
-    df_seller_month['month_name'] = df_seller_month['order_purchase_timestamp'].dt.month_name()
-    df_seller_month = df_seller_month = df_seller_month.groupby(['month_no', 'month_name']).agg({
-        'seller_id': 'nunique',
-        'payment_value': 'mean'
-    }).reset_index()
+# time the serialization of the outputs, done by Dash around each callback
+for entry in app.callback_map.values():
+    if 'callback' in entry:
+        entry['callback'] = metrics.timed('serialize', exclusive=True)(entry['callback'])
+
+
+# Callbacks send the data of the traces only, each figure is assembled in the browser with its template shipped once
+# with the page (assets/figures.js)
+for figure in ('time_serie', 'states', 'sellers'):
+    app.clientside_callback(
+        ClientsideFunction('figures', 'assemble'),
+        Output(figure, 'figure'),
+        [Input(f'{figure}_data', 'data')],
+        [State(f'{figure}_template', 'data')],
+    )
+
+
+# panels computed in the background are dimmed until their poll stops
+for panel in ('states', 'sellers', 'product_table'):
+    app.clientside_callback(
+        ClientsideFunction('panels', 'pending'),
+        Output(f'{panel}_panel', 'className'),
+        [Input(f'{panel}_poll', 'disabled')],
+    )
 
-    fig = plot.sellers(df_seller_rank, df_seller_month)
 
-    return fig
+# cache the default view of the data in the background and keep it up to date
+dataset.start()
 
 
 # -------------------------------------------------------------------------------
@@ -0,0 +1,54 @@
+// Figures are assembled from their template, the layout and the style of each trace shipped once with the page, and
+// the data of their traces sent by the callbacks (see plot.assemble).
+(function() {
+    var TYPED_ARRAYS = {f4: Float32Array, i4: Int32Array};
+
+    function decode(value) {
+        // base64 typed arrays sent when config.PLOT_TYPED_ARRAYS is on
+        var binary = atob(value.bdata);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new TYPED_ARRAYS[value.dtype](bytes.buffer);
+    }
+
+    function copy(value) {
+        return JSON.parse(JSON.stringify(value));
+    }
+
+    function merge(style, trace) {
+        for (var key in trace) {
+            var value = trace[key];
+            if (value !== null && typeof value === 'object' && !Array.isArray(value)) {
+                if (value.bdata !== undefined) {
+                    value = decode(value);
+                } else if (style[key] !== null && typeof style[key] === 'object') {
+                    value = merge(style[key], value);
+                }
+            }
+            style[key] = value;
+        }
+        return style;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        figures: {
+            assemble: function(traces, template) {
+                if (!traces || !template) {
+                    return window.dash_clientside.no_update;
+                }
+
+                // copies of the template, plotly.js writes into the figure it draws
+                return {
+                    data: traces.map(function(trace) {
+                        var data = Object.assign({}, trace);
+                        delete data.role;
+                        return merge(copy(template.traces[trace.role]), data);
+                    }),
+                    layout: copy(template.layout)
+                };
+            }
+        }
+    });
+})();
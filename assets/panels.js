@@ -0,0 +1,8 @@
+// Panels computed as background jobs are dimmed while the page polls their job (see app.cached_output).
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    panels: {
+        pending: function(done) {
+            return done === false ? 'graph_container pending' : 'graph_container';
+        }
+    }
+});
@@ -0,0 +1,50 @@
+'''Speed and agreement of the batch forecast estimators on the daily revenue of every state x product category.
+
+The least squares AR estimator is fitted on all series, the per-series statsmodels ARIMA on the first --series ones
+only. Run from the repository root with `python -m benchmarks.batch_forecast`.
+'''
+import argparse
+import time
+
+import numpy as np
+
+from src import config, data, model
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=50, help='series forecasted with statsmodels')
+    parser.add_argument('--processes', type=int, default=config.FORECAST_BATCH_PROCESSES)
+    args = parser.parse_args()
+
+    store = data.load_store()
+    cube = data.load_cube(store)
+    df_series, dates, x = cube.daily_sales_by(np.arange(len(cube)), config.FORECAST_BATCH_BY)
+    look_ahead = config.FORECAST_LOOK_AHEAD
+    n_css = min(args.series, len(x))
+    print(f'{len(x)} series of {x.shape[1]} days')
+
+    for processes in sorted({1, args.processes}):
+        t_ls, ls = timed(model.predict_batch, dates, x, look_ahead, 'ls', processes)
+        t_css, css = timed(model.predict_batch, dates, x[:n_css], look_ahead, 'css', processes)
+        print(f'{processes} processes: '
+              f'ls {len(x) / t_ls:,.0f} series/s ({t_ls:.2f}s for {len(x)}), '
+              f'css {n_css / t_css:,.1f} series/s ({t_css:.2f}s for {n_css})')
+
+    # agreement on the series both estimators forecasted, relative to the mean level of each series
+    level = np.repeat(np.maximum(x[:n_css].mean(axis=1), 1e-9), look_ahead)
+    ls = ls[ls['series'] < n_css]
+    difference = np.abs(ls['forecast'].to_numpy() - css['forecast'].to_numpy()) / level
+    failed = css.groupby('series')['forecast'].apply(lambda f: f.isna().all()).sum()
+    print(f'forecast difference relative to series level: median {np.nanmedian(difference):.3f}, '
+          f'90th percentile {np.nanpercentile(difference, 90):.3f}, statsmodels failures {failed}/{n_css}')
+
+
+if __name__ == '__main__':
+    main()
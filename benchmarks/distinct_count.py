@@ -0,0 +1,105 @@
+'''Accuracy and speed of HyperLogLog distinct counts against exact pandas counts on the processed orders.
+
+Run from the repository root with `python -m benchmarks.distinct_count`.
+'''
+import time
+
+import numpy as np
+import pandas as pd
+
+from src import config, data, sketch
+
+ERRORS = [0.05, 0.02, 0.01, 0.005]
+COLUMNS = ['order_id', 'customer_id', 'seller_id']
+
+
+def timeit(f, repeat=5):
+    best, result = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def relative_error(estimate, exact):
+    exact = np.asarray(exact, dtype=np.float64)
+    return np.abs(np.asarray(estimate) - exact) / np.maximum(exact, 1.)
+
+
+def main():
+    store = data.OrderStore.from_frame(pd.read_csv(
+        config.get_processed_filename(config.DATA_FILES['order']),
+        usecols=config.STORE_COLUMNS,
+    ))
+    df = store.take()
+    df_object = df.astype({name: object for name in COLUMNS})
+    day = store.columns['order_purchase_timestamp'] - store.columns['order_purchase_timestamp'].min()
+    n_days = int(day.max()) + 1
+
+    rows = []
+    for name in COLUMNS:
+        t_exact, exact = timeit(lambda: df_object[name].nunique())
+        t_exact_daily, exact_daily = timeit(lambda: df_object.groupby(day)[name].nunique().reindex(range(n_days)))
+        exact_daily = exact_daily.fillna(0).to_numpy()
+
+        for error in ERRORS:
+            p = sketch.precision(error)
+            codes = store.columns[name]
+            t_hll, estimate = timeit(lambda: sketch.count_distinct(codes, p))
+            t_hll_daily, estimate_daily = timeit(lambda: sketch.count_distinct(codes, p, day, n_days))
+            daily_error = relative_error(estimate_daily, exact_daily)
+
+            rows.append({
+                'column': name,
+                'error bound': error,
+                'precision': p,
+                'exact': exact,
+                'estimate': estimate,
+                'error': relative_error(estimate, exact),
+                'daily mean error': daily_error.mean(),
+                'daily max error': daily_error.max(),
+                'pandas (ms)': 1000 * t_exact,
+                'hll (ms)': 1000 * t_hll,
+                'pandas daily (ms)': 1000 * t_exact_daily,
+                'hll daily (ms)': 1000 * t_hll_daily,
+            })
+
+    # merging cube cells, the path used by the application
+    cubes = []
+    t_build, cube = timeit(lambda: data.build_cube(store, 'exact'), repeat=1)
+    cubes.append(('exact', cube, t_build))
+    for error in ERRORS:
+        config.HLL_ERROR = error
+        t_build, cube = timeit(lambda: data.build_cube(store, 'hll'), repeat=1)
+        cubes.append((f'hll {error}', cube, t_build))
+
+    exact_cube = cubes[0][1]
+    cells = np.arange(len(exact_cube))
+    cube_day = exact_cube.dimensions['order_purchase_timestamp'] - exact_cube.dimensions['order_purchase_timestamp'][0]
+    cube_rows = []
+    for mode, cube, t_build in cubes:
+        for name in COLUMNS:
+            t_total, total = timeit(lambda: cube.count_distinct(name, cells))
+            t_daily, daily = timeit(lambda: cube.count_distinct(name, cells, cube_day, n_days))
+            exact_daily = exact_cube.count_distinct(name, cells, cube_day, n_days)
+            cube_rows.append({
+                'mode': mode,
+                'column': name,
+                'build (s)': t_build,
+                'distinct': total,
+                'error': relative_error(total, exact_cube.count_distinct(name, cells)),
+                'daily mean error': relative_error(daily, exact_daily).mean(),
+                'total (ms)': 1000 * t_total,
+                'daily (ms)': 1000 * t_daily,
+            })
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 20, 'display.precision', 4):
+        print(f'{len(store)} rows\n')
+        print(pd.DataFrame(rows).to_string(index=False), end='\n\n')
+        print(pd.DataFrame(cube_rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,474 @@
+'''Load test of the callback endpoint replaying filter sessions against a local server.
+
+A session is a list of steps, each holding the /_dash-update-component requests fired together by one interaction.
+Sessions are either generated from the layout and callbacks served by the application (first page load, date range
+drags, dropdown toggles and resets to the defaults) or recorded from the traffic logged by the application with
+TRAFFIC_LOG in src/config.py:
+
+    python -m benchmarks.load_test record --output sessions.jsonl
+
+Virtual users replay the sessions in turn for --duration seconds, the requests of a step in parallel like a
+browser, each session as a new page with its own session id. Panels computed as background jobs answer with no
+update until their job is done: their callback is sent again on every tick of its poll, as the page does, and timed
+until the panel is served. The server is started with --server for each number of --workers (gunicorn as in the Procfile by default)
+unless --url targets a running one. Throughput and p50/p95/p99 latencies per callback are reported for every number
+of workers and of users:
+
+    python -m benchmarks.load_test run --workers 1 2 4 --users 1 4 16 --duration 30
+'''
+import argparse
+import contextlib
+import glob
+import http.client
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+
+from src import config
+
+RESULTS = os.path.join(os.path.dirname(__file__), 'results')
+ENDPOINT = '/_dash-update-component'
+SERVER = 'gunicorn --workers {workers} --bind 127.0.0.1:{port} --timeout 300 app:server'
+# requests of a step sent at once, as the connections per host of a browser
+PARALLEL_REQUESTS = 6
+# store identifying the page to the background jobs of its panels (see app.serve_layout)
+SESSION = ('session', 'data')
+# seconds after which a panel still computed in the background counts as an error
+POLL_TIMEOUT = 300
+
+
+class Client:
+    '''keep-alive HTTP connections to the server, one per thread.
+    '''
+
+    def __init__(self, url):
+        url = urlsplit(url)
+        self.host, self.port = url.hostname, url.port or 80
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=300)
+
+        return self._local.connection
+
+    def request(self, method, path, body=None):
+        '''(status, seconds, body) of a request, status 0 when the connection failed.
+        '''
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        start = time.perf_counter()
+        try:
+            connection = self._connection()
+            connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+            return response.status, time.perf_counter() - start, content
+        except (OSError, http.client.HTTPException):
+            self._local.connection = None
+            return 0, time.perf_counter() - start, None
+
+    def get_json(self, path):
+        status, _, content = self.request('GET', path)
+        if status != 200:
+            raise ConnectionError(f'GET {path} failed with status {status}')
+
+        return json.loads(content)
+
+
+# sessions
+class Page:
+    '''properties of the components of the served layout and the server callbacks firing on their changes.
+    '''
+
+    def __init__(self, client):
+        self.defaults = {}
+        self.components = {}
+        self._walk(client.get_json('/_dash-layout'))
+        self.callbacks = [
+            callback for callback in client.get_json('/_dash-dependencies') if not callback.get('clientside_function')
+        ]
+
+    def _walk(self, component):
+        if isinstance(component, list):
+            for child in component:
+                self._walk(child)
+            return
+        if not isinstance(component, dict) or 'props' not in component:
+            return
+
+        props = component['props']
+        if 'id' in props:
+            self.components[props['id']] = component
+            for name, value in props.items():
+                if name not in ('id', 'children'):
+                    self.defaults[(props['id'], name)] = value
+        self._walk(props.get('children'))
+
+    def requests(self, values, changed=None):
+        '''bodies of the requests of the callbacks with an input among the changed properties, all the callbacks
+        when changed is None.
+        '''
+        def props(items):
+            return [{'id': item['id'], 'property': item['property'], 'value': values.get((item['id'], item['property']))}
+                    for item in items]
+
+        bodies = []
+        for callback in self.callbacks:
+            inputs = {(item['id'], item['property']) for item in callback['inputs']}
+            if changed is not None and not set(changed) & inputs:
+                continue
+
+            bodies.append({
+                'output': callback['output'],
+                'inputs': props(callback['inputs']),
+                'state': props(callback.get('state', [])),
+                'changedPropIds': [f'{i}.{p}' for i, p in (changed or [])],
+            })
+
+        return bodies
+
+    def date_ranges(self):
+        return [key for key, component in self.components.items()
+                if {'start_date', 'end_date'} <= set(component['props'])]
+
+    def dropdowns(self):
+        return [key for key, component in self.components.items()
+                if component['props'].get('multi') and component['props'].get('options')]
+
+
+def generate_sessions(page, n_sessions, n_steps, seed=0):
+    '''sessions starting with the first page load followed by random date range drags, dropdown toggles and resets.
+    '''
+    rng = random.Random(seed)
+    sessions = []
+    for i in range(n_sessions):
+        values = dict(page.defaults)
+        steps = [{'action': 'load', 'requests': page.requests(values)}]
+
+        while len(steps) < n_steps:
+            action = rng.choices(['drag', 'toggle', 'reset'], weights=[.45, .45, .1])[0]
+            if action == 'drag' and page.date_ranges():
+                steps.extend(_drag(page, values, rng.choice(page.date_ranges()), rng))
+            elif action == 'toggle' and page.dropdowns():
+                steps.append(_toggle(page, values, rng.choice(page.dropdowns()), rng))
+            else:
+                changed = [key for key, value in values.items() if value != page.defaults[key]]
+                values = dict(page.defaults)
+                if changed:
+                    steps.append({'action': 'reset', 'requests': page.requests(values, changed)})
+
+        sessions.append({'name': f'generated-{i}', 'steps': steps[:n_steps]})
+
+    return sessions
+
+
+def _drag(page, values, component, rng):
+    # one end of the range moved a few days at a time, each move fires the callbacks
+    props = page.components[component]['props']
+    first = _date(props.get('min_date_allowed') or props['start_date'])
+    last = _date(props.get('max_date_allowed') or props['end_date'])
+    end = rng.choice(['start_date', 'end_date'])
+
+    steps = []
+    for _ in range(rng.randint(2, 6)):
+        start_date, end_date = _date(values[(component, 'start_date')]), _date(values[(component, 'end_date')])
+        move = timedelta(days=rng.randint(3, 30)) * rng.choice([-1, 1])
+        if end == 'start_date':
+            start_date = min(max(start_date + move, first), end_date)
+        else:
+            end_date = max(min(end_date + move, last), start_date)
+        values[(component, 'start_date')], values[(component, 'end_date')] = str(start_date), str(end_date)
+        steps.append({'action': 'drag', 'requests': page.requests(values, [(component, end)])})
+
+    return steps
+
+
+def _toggle(page, values, component, rng):
+    # one option removed from the selection or added back
+    selected = list(values[(component, 'value')] or [])
+    options = [option['value'] for option in page.components[component]['props']['options']]
+    missing = [option for option in options if option not in selected]
+    if missing and (len(selected) <= 1 or rng.random() < .5):
+        selected.append(rng.choice(missing))
+    elif selected:
+        selected.remove(rng.choice(selected))
+    values[(component, 'value')] = selected
+
+    return {'action': 'toggle', 'requests': page.requests(values, [(component, 'value')])}
+
+
+def _date(value):
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date() if not isinstance(value, date) else value
+
+
+def record_sessions(paths, step_gap, session_gap):
+    '''sessions of the callback requests logged by the application: the requests of a client are split in steps
+    when more than step_gap seconds apart and in sessions when more than session_gap seconds apart.
+    '''
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+
+    sessions = []
+    for client, df in pd.DataFrame(records).sort_values('time').groupby('client', sort=False):
+        gaps = df['time'].diff().fillna(np.inf).to_numpy()
+        steps, session = [], 0
+        for gap, body in zip(gaps, df['body']):
+            if gap > session_gap and steps:
+                sessions.append({'name': f'{client}-{session}', 'steps': steps})
+                steps, session = [], session + 1
+            if gap > step_gap or not steps:
+                steps.append({'action': 'recorded', 'requests': []})
+            steps[-1]['requests'].append(body)
+        sessions.append({'name': f'{client}-{session}', 'steps': steps})
+
+    return sessions
+
+
+def read_sessions(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_sessions(sessions, path):
+    with open(path, 'w') as f:
+        for session in sessions:
+            f.write(json.dumps(session) + '\n')
+
+
+# load
+def replay(client, sessions, users, duration, think_time=0., poll_interval=None):
+    '''replay the sessions with concurrent users for duration seconds, each user starting a session where the
+    previous one ended. Returns the (output, status, seconds, polls) of every callback, timed until its output is
+    served, and the elapsed seconds.
+    '''
+    poll_interval = config.JOB_POLL_INTERVAL / 1000 if poll_interval is None else poll_interval
+    deadline = time.perf_counter() + duration
+    records = []
+    lock = threading.Lock()
+
+    def user(index):
+        pool = ThreadPoolExecutor(PARALLEL_REQUESTS)
+        session = index
+        while time.perf_counter() < deadline:
+            page = uuid.uuid4().hex
+            for step in sessions[session % len(sessions)]['steps']:
+                if time.perf_counter() >= deadline:
+                    break
+
+                responses = list(pool.map(
+                    lambda body: serve_callback(client, _with_session(body, page), poll_interval), step['requests']))
+                with lock:
+                    records.extend(responses)
+                time.sleep(think_time)
+            session += users
+        pool.shutdown()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return records, time.perf_counter() - start
+
+
+def serve_callback(client, body, poll_interval):
+    '''(output, status, seconds, polls) of a callback until its output is served: while it answers without its
+    output and with the poll of its job running, it is sent again on every tick of the poll. Status is 0 for panels
+    not served within POLL_TIMEOUT seconds.
+    '''
+    start = time.perf_counter()
+    polls = 0
+    while True:
+        status, _, content = client.request('POST', ENDPOINT, body)
+        running = _running_polls(body, json.loads(content)) if status == 200 else []
+        if not running:
+            return body['output'], status, time.perf_counter() - start, polls
+        if time.perf_counter() - start > POLL_TIMEOUT:
+            return body['output'], 0, time.perf_counter() - start, polls
+
+        time.sleep(poll_interval)
+        body, polls = _tick(body, running), polls + 1
+
+
+def _outputs(output):
+    return [output for output in output.strip('.').split('...') if output]
+
+
+def _running_polls(body, content):
+    # polls enabled by a response that lacks one of the other outputs of the callback
+    response = content.get('response', {})
+    running = [component for component, props in response.items() if props.get('disabled') is False]
+    served = all(
+        prop in response.get(component, {})
+        for component, prop in (output.rsplit('.', 1) for output in _outputs(body['output']))
+        if component not in running
+    )
+
+    return [] if served else running
+
+
+def _tick(body, polls):
+    inputs = [
+        dict(item, value=(item['value'] or 0) + 1)
+        if item['id'] in polls and item['property'] == 'n_intervals' else item
+        for item in body['inputs']
+    ]
+    return dict(body, inputs=inputs, changedPropIds=[f'{poll}.n_intervals' for poll in polls])
+
+
+def _with_session(body, page):
+    state = [dict(item, value=page) if (item['id'], item['property']) == SESSION else item
+             for item in body.get('state', [])]
+    return dict(body, state=state)
+
+
+def summarize(records, elapsed):
+    '''throughput and latency percentiles (ms) per callback output and for all of them.
+    '''
+    df = pd.DataFrame(records, columns=['output', 'status', 'seconds', 'polls'])
+    df['output'] = df['output'].map(_label)
+    # 204 is a PreventUpdate of the callback, a valid answer
+    df['ok'] = df['status'].isin([200, 204])
+
+    rows = []
+    for output, group in [('all', df)] + list(df.groupby('output')):
+        seconds = group.loc[group['ok'], 'seconds'].to_numpy() * 1000
+        p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) if len(seconds) else (np.nan,) * 3
+        rows.append({
+            'callback': output,
+            'requests': len(group),
+            'polls': int(group['polls'].sum()),
+            'errors': int((~group['ok']).sum()),
+            'throughput': group['ok'].sum() / elapsed,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'p99_ms': p99,
+        })
+
+    return rows
+
+
+def _label(output):
+    # first output of a callback, with the number of the other ones
+    outputs = _outputs(output)
+    return outputs[0] if len(outputs) == 1 else f'{outputs[0]} (+{len(outputs) - 1})'
+
+
+@contextlib.contextmanager
+def serve(command, workers, port, timeout, log):
+    '''start the server with the given number of workers, its output written to log, and wait until it serves the
+    layout.
+    '''
+    url = f'http://127.0.0.1:{port}'
+    with open(log, 'a') as f:
+        process = subprocess.Popen(shlex.split(command.format(workers=workers, port=port)), stdout=f,
+                                   stderr=subprocess.STDOUT)
+    try:
+        client = Client(url)
+        deadline = time.time() + timeout
+        while client.request('GET', '/_dash-layout')[0] != 200:
+            if process.poll() is not None or time.time() > deadline:
+                raise RuntimeError(f'the server did not start, see {log}')
+            time.sleep(.5)
+
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(args):
+    sessions = read_sessions(args.sessions) if args.sessions else None
+    results = []
+
+    def sweep(url, workers):
+        nonlocal sessions
+        client = Client(url)
+        if sessions is None:
+            sessions = generate_sessions(Page(client), args.n_sessions, args.steps, args.seed)
+
+        replay(client, sessions, max(args.users), args.warmup, args.think_time, args.poll_interval)
+        for users in args.users:
+            records, elapsed = replay(client, sessions, users, args.duration, args.think_time, args.poll_interval)
+            for row in summarize(records, elapsed):
+                results.append(dict(workers=workers, users=users, **row))
+                if row['callback'] == 'all':
+                    print(f'{workers} workers, {users} users: {row["throughput"]:.1f} callbacks/s, '
+                          f'p50 {row["p50_ms"]:.0f} ms, p99 {row["p99_ms"]:.0f} ms, {row["errors"]} errors',
+                          file=sys.stderr)
+
+    os.makedirs(RESULTS, exist_ok=True)
+    if args.url:
+        sweep(args.url, None)
+    else:
+        for workers in args.workers:
+            with serve(args.server, workers, args.port, args.start_timeout,
+                       os.path.join(RESULTS, f'load-{args.name}-server.log')) as url:
+                sweep(url, workers)
+
+    df = pd.DataFrame(results)
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.precision', 1):
+        print(df.to_string(index=False))
+
+    filename = os.path.join(RESULTS, f'load-{args.name}.json')
+    with open(filename, 'w') as f:
+        json.dump({'name': args.name, 'arguments': vars(args), 'results': results}, f, indent=1)
+    print(f'\nresults saved to {filename}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay filter sessions against the callback endpoint')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record = commands.add_parser('record', help='sessions of the traffic logged by the application')
+    record.add_argument('logs', nargs='*', help=f'traffic logs, all of {config.DIR_TRAFFIC} by default')
+    record.add_argument('--output', required=True)
+    record.add_argument('--step-gap', type=float, default=.5, help='seconds between two interactions')
+    record.add_argument('--session-gap', type=float, default=1800., help='seconds between two sessions')
+
+    load = commands.add_parser('run', help='replay sessions and report throughput and latencies')
+    load.add_argument('--sessions', help='recorded sessions, generated from the served page when not given')
+    load.add_argument('--n-sessions', type=int, default=20, help='sessions generated')
+    load.add_argument('--steps', type=int, default=20, help='steps of the generated sessions')
+    load.add_argument('--seed', type=int, default=0)
+    load.add_argument('--url', help='running server to test instead of starting one')
+    load.add_argument('--server', default=SERVER, help='command starting the server, with {workers} and {port}')
+    load.add_argument('--port', type=int, default=8050)
+    load.add_argument('--start-timeout', type=float, default=600., help='seconds to wait for the server')
+    load.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    load.add_argument('--users', type=int, nargs='+', default=[1, 4, 16], help='concurrent users')
+    load.add_argument('--duration', type=float, default=30., help='seconds of load per measure')
+    load.add_argument('--warmup', type=float, default=5., help='seconds of load before the measures')
+    load.add_argument('--think-time', type=float, default=0., help='seconds between the steps of a user')
+    load.add_argument('--poll-interval', type=float, help='seconds between the polls of a background panel, '
+                                                          'config.JOB_POLL_INTERVAL by default')
+    load.add_argument('--name', default=datetime.now().strftime('%Y%m%d-%H%M%S'), help='name of the results')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        logs = args.logs or sorted(glob.glob(os.path.join(config.DIR_TRAFFIC, '*.jsonl')))
+        sessions = record_sessions(logs, args.step_gap, args.session_gap)
+        write_sessions(sessions, args.output)
+        print(f'{len(sessions)} sessions, {sum(len(session["steps"]) for session in sessions)} steps')
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
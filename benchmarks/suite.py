@@ -0,0 +1,388 @@
+'''Time and peak memory of the data, KPI, figure and callback functions on synthetic orders of growing size.
+
+Every benchmark runs at each scale (multiple of the Olist size, see benchmarks.synthetic) and, when it depends on
+the filters, for each selection: all the orders, the last quarter, and the last quarter of one state, three
+categories and one payment type. Generated stores are kept in --data and reused by the next runs. Importing the
+application for the callback benchmarks loads its own dataset as well.
+
+Run from the repository root with `python -m benchmarks.suite --scales 1 10 100`. Results are saved to
+benchmarks/results/<name>.json, `--compare benchmarks/results/<name>.json` prints the ratio of the median times
+to that run and exits with status 1 when a benchmark is slower than --threshold times.
+'''
+import argparse
+import inspect
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from src import config, data, kpi, live, plot
+from .synthetic import Generator
+
+RESULTS = os.path.join(os.path.dirname(__file__), 'results')
+
+# benchmarks by name, each one a function of the context (and of the selection) returning the call to measure so
+# that its setup is not measured
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, selections=True):
+    '''declare a benchmark, run for every selection unless selections is False.
+    '''
+    def decorator(function):
+        BENCHMARKS[name] = (function, selections)
+        return function
+
+    return decorator
+
+
+class Context:
+    '''synthetic store and cube of one scale, with the selections the benchmarks run on.
+    '''
+
+    def __init__(self, scale, seed, directory):
+        self.scale = scale
+        self.generator = Generator(scale, seed)
+
+        path = os.path.join(directory, f'x{scale:g}-{seed}')
+        if not os.path.isdir(path):
+            self.generator.store().save(path)
+        self.store = data.OrderStore.load(path)
+        self.cube = data.build_cube(self.store)
+        self.snapshot = live.Snapshot(self.store, self.cube)
+        self.month = self.generator.months[len(self.generator.months) // 2]
+        self._df = None
+
+        self.selections = selections(self.store)
+
+    @property
+    def df(self):
+        # decoded orders for the DataFrame functions, only when one of them runs
+        if self._df is None:
+            self._df = self.store.take()
+
+        return self._df
+
+    def cells(self, selection):
+        return self.cube.cells(*selection)
+
+    def orders(self, selection):
+        return data.filter_dataframe(self.df, *selection)
+
+
+def selections(store):
+    end_date = store.max_date()
+    start_date = str(end_date - timedelta(days=90))
+    payment_types = store.values('payment_type')
+    categories = store.values('product_category_name')
+    states = store.values('state_name')
+
+    # most frequent values of the narrow selection
+    def top(name, n):
+        counts = np.bincount(store.columns[name][store.columns[name] >= 0])
+        return list(store.dictionaries[name][np.argsort(counts)[::-1][:n]])
+
+    return OrderedDict([
+        ('all', data.filter_signature(str(store.min_date()), str(end_date), payment_types, categories, states)),
+        ('quarter', data.filter_signature(start_date, str(end_date), payment_types, categories, states)),
+        ('narrow', data.filter_signature(start_date, str(end_date), top('payment_type', 1),
+                                         top('product_category_name', 3), top('state_name', 1))),
+    ])
+
+
+# data
+@benchmark('data.filter_dataframe')
+def _filter_dataframe(context, selection):
+    df = context.df
+    return lambda: data.filter_dataframe(df, *selection)
+
+
+@benchmark('data.OrderStore.rows')
+def _store_rows(context, selection):
+    return lambda: context.store.rows(*selection)
+
+
+@benchmark('data.OrderStore.take')
+def _store_take(context, selection):
+    rows = context.store.rows(*selection)
+    return lambda: context.store.take(rows)
+
+
+@benchmark('data.OrderStore.seller_sales')
+def _seller_sales(context, selection):
+    rows = context.store.rows(*selection)
+    return lambda: context.store.seller_sales(rows)
+
+
+@benchmark('data.OrderCube.cells')
+def _cube_cells(context, selection):
+    return lambda: context.cube.cells(*selection)
+
+
+@benchmark('data.OrderCube.daily_sales')
+def _daily_sales(context, selection):
+    cells = context.cells(selection)
+    return lambda: context.cube.daily_sales(cells)
+
+
+@benchmark('data.OrderCube.state_sales')
+def _state_sales(context, selection):
+    cells = context.cells(selection)
+    return lambda: context.cube.state_sales(cells)
+
+
+@benchmark('data.OrderCube.product_categories')
+def _product_categories(context, selection):
+    cells = context.cells(selection)
+    return lambda: context.cube.product_categories(cells)
+
+
+@benchmark('data.OrderCube.prefix_sums')
+def _prefix_sums(context, selection):
+    cells = context.cells(selection)
+    return lambda: context.cube.prefix_sums(cells)
+
+
+@benchmark('data.build_cube', selections=False)
+def _build_cube(context):
+    return lambda: data.build_cube(context.store)
+
+
+@benchmark('data.join_facts', selections=False)
+def _join_facts(context):
+    facts = context.generator.facts(context.month)
+    return lambda: data.join_facts(facts, {'seller': context.generator.sellers})
+
+
+@benchmark('data.OrderStore.from_frame', selections=False)
+def _store_from_frame(context):
+    df = context.generator.sales(context.month)['sales'][config.STORE_COLUMNS]
+    return lambda: data.OrderStore.from_frame(df)
+
+
+# KPIs
+@benchmark('kpi.compute')
+def _kpi_compute(context, selection):
+    rows = context.store.rows(*selection)
+    prefix_sums = context.cube.prefix_sums(context.cube.cells(
+        str(context.store.min_date()), str(context.store.max_date()), *selection[2:]))
+    start_day, end_day = data.to_epoch_day(list(selection[:2]))
+    return lambda: kpi.compute(context.store, rows, prefix_sums, start_day, end_day)
+
+
+def _dataframe_kpi(function):
+    def setup(context, selection):
+        df = context.orders(selection)
+        return lambda: function(df)
+
+    return setup
+
+
+for _function in (data.revenue, data.aov, data.abandonment_rate, data.order_satisfaction):
+    benchmark(f'data.{_function.__name__}')(_dataframe_kpi(_function))
+
+
+# figures
+def _timeserie_frames(context, selection):
+    df = context.cube.daily_sales(context.cells(selection))
+    prefix_sums = context.cube.prefix_sums(context.cube.cells(
+        str(context.store.min_date()), str(context.store.max_date()), *selection[2:]))
+    start_day, end_day = data.to_epoch_day(df['order_purchase_timestamp'].iloc[[0, -1]])
+
+    return df, None, False, prefix_sums.rolling_mean('payment_value', 30, start_day, end_day)
+
+
+def _map_frames(context, selection):
+    df_map, df_time = context.cube.state_sales(context.cells(selection))
+    df_map['text'] = df_map['state_name'] + ': ' + df_map['payment_value'].apply(lambda x: f'R$ {x:,.0f}')
+
+    return df_map, df_time
+
+
+def _seller_frames(context, selection):
+    # inputs of the sellers chart as computed by the callback
+    return context.store.seller_sales(context.store.rows(*selection))
+
+
+def _figure(function, frames):
+    def setup(context, selection):
+        args = frames(context, selection)
+        return lambda: function(*args)
+
+    return setup
+
+
+for _function, _frames in (
+        (plot.sales_timeserie, _timeserie_frames),
+        (plot.sales_timeserie_data, _timeserie_frames),
+        (plot.sales_map, _map_frames),
+        (plot.sales_map_data, _map_frames),
+        (plot.sellers, _seller_frames),
+        (plot.sellers_data, _seller_frames),
+):
+    benchmark(f'plot.{_function.__name__}')(_figure(_function, _frames))
+
+
+@benchmark('plot.lttb', selections=False)
+def _lttb(context):
+    x = context.store.columns['order_purchase_timestamp'].astype(np.float64)
+    y = context.store.columns['payment_value']
+    return lambda: plot.lttb(x, y, config.PLOT_WIDTH * config.PLOT_POINTS_PER_PIXEL)
+
+
+# callbacks, their body without the output cache and with the filter caches of the application emptied
+def _callback(name):
+    def setup(context, selection):
+        import app
+
+        function = inspect.unwrap(getattr(app, name))
+        if name == 'make_timeserie':
+            # the chart with its forecast fitted, as served once the polling stops
+            while not function(context.snapshot, selection)[1]:
+                time.sleep(.1)
+
+        def call():
+            for value in vars(app).values():
+                if hasattr(value, 'cache_clear'):
+                    value.cache_clear()
+
+            return function(context.snapshot, selection)
+
+        return call
+
+    return setup
+
+
+for _name in ('update_kpis', 'make_timeserie', 'make_states', 'make_product_categories', 'make_sellers'):
+    benchmark(f'app.{_name}')(_callback(_name))
+
+
+def measure(call, repeat):
+    '''minimum and median seconds over repeat calls and peak traced memory in bytes of one more call.
+    '''
+    # a first call out of the measures fills the caches built once per process (figure templates...)
+    call()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(times), float(np.median(times)), peak
+
+
+def run(scales, seed, directory, repeat, only=None):
+    results = []
+    for scale in scales:
+        context = Context(scale, seed, directory)
+        print(f'scale {scale:g}: {len(context.store)} rows, {len(context.cube)} cells', file=sys.stderr)
+
+        for name, (function, by_selection) in BENCHMARKS.items():
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+
+            for selection_name, selection in (context.selections.items() if by_selection else [(None, None)]):
+                call = function(context, selection) if by_selection else function(context)
+                best, median, peak = measure(call, repeat)
+                results.append({
+                    'benchmark': name,
+                    'scale': scale,
+                    'selection': selection_name,
+                    'rows': len(context.store),
+                    'min_ms': 1000 * best,
+                    'median_ms': 1000 * median,
+                    'peak_mb': peak / 2 ** 20,
+                })
+                print(f'{name} x{scale:g} {selection_name or "-"}: {1000 * median:.2f} ms, {peak / 2 ** 20:.1f} MB',
+                      file=sys.stderr)
+
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'aggregate_workers': config.AGGREGATE_WORKERS,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''ratio of the median times to those of the baseline run, True when none exceeds threshold.
+    '''
+    keys = ['benchmark', 'scale', 'selection']
+    df = pd.DataFrame(results).merge(pd.DataFrame(baseline['results']), how='inner', on=keys,
+                                     suffixes=('', '_baseline'))
+    df['ratio'] = df['median_ms'] / df['median_ms_baseline']
+    df['regression'] = df['ratio'] > threshold
+
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.precision', 3):
+        print(f'\ncompared to {baseline["name"]} ({baseline["environment"]["commit"]})')
+        print(df[keys + ['median_ms_baseline', 'median_ms', 'ratio', 'regression']].to_string(index=False))
+
+    return not df['regression'].any()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=float, nargs='+', default=[1., 10., 100.],
+                        help='sizes as multiples of the Olist dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', help='run the benchmarks whose name starts with one of these')
+    parser.add_argument('--data', default=os.path.join(config.DIR_DATA, 'synthetic'),
+                        help='directory of the generated stores')
+    parser.add_argument('--name', default=datetime.now().strftime('%Y%m%d-%H%M%S'), help='name of the results')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    parser.add_argument('--workers', type=int, default=config.AGGREGATE_WORKERS,
+                        help='threads of the aggregation engine, 1 to aggregate in the calling thread only')
+    args = parser.parse_args()
+    config.AGGREGATE_WORKERS = args.workers
+
+    results = run(args.scales, args.seed, args.data, args.repeat, args.only)
+
+    os.makedirs(RESULTS, exist_ok=True)
+    filename = os.path.join(RESULTS, f'{args.name}.json')
+    with open(filename, 'w') as f:
+        json.dump({'name': args.name, 'environment': environment(), 'results': results}, f, indent=1)
+
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.precision', 3):
+        print(pd.DataFrame(results).drop(columns='rows').to_string(index=False))
+    print(f'\nresults saved to {filename}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+'''Synthetic orders with the schema and the skew of the Olist dataset, at any multiple of its size.
+
+Orders are generated one month at a time as the normalized facts of src.data (orders, items, payments and the
+seller dimension) and joined with data.join_facts, the path of data.consolidate_dataset. Volume grows over the two
+years of the dataset with weekly seasonality and Black Friday, and customer states, product categories, product
+and seller popularity, prices and statuses follow the shares of the real dataset. The same scale and seed always
+give the same orders.
+
+Write the monthly partitions of every fact with
+`python -m benchmarks.synthetic --scale 10 --output data/synthetic/x10`, the directory has the layout of
+config.DATA_PARTITIONS.
+'''
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import config, data, sketch
+
+# size and span of the Olist dataset
+N_ORDERS = 99441
+N_PRODUCTS = 32951
+N_SELLERS = 3095
+START_DATE = '2016-09-04'
+END_DATE = '2018-10-17'
+
+ORDER_STATUS = {
+    'delivered': .9702, 'shipped': .0111, 'canceled': .0063, 'unavailable': .0061, 'invoiced': .0032,
+    'processing': .0030, 'created': .0001,
+}
+CUSTOMER_STATE = {
+    'SP': .4198, 'RJ': .1292, 'MG': .1170, 'RS': .0550, 'PR': .0507, 'SC': .0366, 'BA': .0340, 'DF': .0215,
+    'ES': .0204, 'GO': .0203, 'PE': .0166, 'CE': .0134, 'PA': .0098, 'MT': .0091, 'MA': .0075, 'MS': .0072,
+    'PB': .0054, 'PI': .0050, 'RN': .0049, 'AL': .0041, 'SE': .0034, 'TO': .0028, 'RO': .0025, 'AM': .0015,
+    'AC': .0008, 'AP': .0007, 'RR': .0005,
+}
+PAYMENT_TYPE = {'credit_card': .7392, 'boleto': .1904, 'voucher': .0556, 'debit_card': .0148}
+REVIEW_SCORE = {5: .5780, 4: .1929, 3: .0824, 2: .0318, 1: .1149}
+# shares of the orders with 1, 2... items and payments, and of the orders without review
+N_ITEMS = [.9050, .0762, .0118, .0051, .0019]
+N_PAYMENTS = [.9702, .0226, .0053, .0019]
+NO_REVIEW = .0077
+# hourly shares of the purchases, low at night
+HOURS = np.array([2.4, 1.1, .5, .3, .2, .2, .5, 1.2, 3., 4.8, 6.2, 6.3, 6., 6.5, 6.7, 6.4, 6.3, 6., 5.6, 5.8,
+                  6.2, 6.1, 5.7, 4.])
+WEEKDAYS = np.array([1.16, 1.13, 1.1, 1.07, 1.02, .74, .78])
+BLACK_FRIDAY = '2017-11-24'
+
+
+class Generator:
+    '''synthetic orders at scale times the Olist size, generated month by month.
+    '''
+
+    def __init__(self, scale=1., seed=0):
+        self.scale = scale
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+
+        # purchase day of every order: a ramp over the history, weekly seasonality and a Black Friday peak
+        days = np.arange(np.datetime64(START_DATE), np.datetime64(END_DATE) + 1)
+        weights = np.clip(np.linspace(-.15, 1., len(days)), .01, None) * WEEKDAYS[(days.astype(np.int64) + 3) % 7]
+        weights[days == np.datetime64(BLACK_FRIDAY)] *= 5.
+        self.days = np.sort(rng.choice(days, int(round(N_ORDERS * scale)), p=weights / weights.sum()))
+        self.months = np.unique(self.days.astype('datetime64[M]'))
+
+        # products: Zipf popularity, a category following the shares of the real catalog, a price and a seller
+        n_products = max(int(round(N_PRODUCTS * scale)), 1)
+        categories = _product_categories()
+        self.product_weights = _zipf(n_products, 1.05, rng)
+        self.product_category = rng.choice(categories.index.to_numpy(), n_products, p=categories.to_numpy())
+        self.product_price = np.round(np.exp(rng.normal(np.log(75.), .9, n_products)) + .85, 2)
+        n_sellers = max(int(round(N_SELLERS * scale)), 1)
+        self.product_seller = rng.choice(n_sellers, n_products, p=_zipf(n_sellers, .9, rng))
+
+        seller_states = _seller_states()
+        self.sellers = pd.DataFrame({
+            'seller_id': _ids(np.arange(n_sellers), 'seller', seed),
+            'seller_zip_code_prefix': rng.integers(1000, 99990, n_sellers),
+            'seller_state': rng.choice(seller_states.index.to_numpy(), n_sellers, p=seller_states.to_numpy()),
+        })
+        self.sellers.insert(2, 'seller_city', self.sellers['seller_state'].str.lower())
+
+        self.states = pd.read_csv(config.STATES)
+
+    def __len__(self):
+        return len(self.days)
+
+    def facts(self, month):
+        '''orders, items and payments facts of the orders purchased in the month, as given by data.order_facts.
+        '''
+        month = np.datetime64(month, 'M')
+        first, last = self.days.searchsorted([month.astype('datetime64[D]'), (month + 1).astype('datetime64[D]')])
+        orders = np.arange(first, last)
+        n_orders = len(orders)
+        rng = np.random.default_rng([self.seed, int(month.astype(np.int64))])
+
+        purchase = (self.days[orders].astype('datetime64[s]')
+                    + rng.choice(24, n_orders, p=HOURS / HOURS.sum()) * 3600 + rng.integers(0, 3600, n_orders))
+        status = rng.choice(list(ORDER_STATUS), n_orders, p=_shares(ORDER_STATUS))
+        approved = purchase + rng.gamma(1., 10. * 3600, n_orders).astype('timedelta64[s]')
+        carrier = approved + rng.gamma(2., 1.4 * 86400, n_orders).astype('timedelta64[s]')
+        delivered = carrier + rng.gamma(3., 3. * 86400, n_orders).astype('timedelta64[s]')
+        estimated = (purchase + rng.normal(24., 8., n_orders).clip(3.).astype('timedelta64[D]')).astype('datetime64[D]')
+        shipped = np.isin(status, ['delivered', 'shipped'])
+
+        customer_state = rng.choice(list(CUSTOMER_STATE), n_orders, p=_shares(CUSTOMER_STATE))
+        review_score = rng.choice(list(REVIEW_SCORE), n_orders, p=_shares(REVIEW_SCORE)).astype(np.float64)
+        review_score[rng.random(n_orders) < NO_REVIEW] = np.nan
+
+        df_order = pd.DataFrame({
+            'order_id': _ids(orders, 'order', self.seed),
+            'customer_id': _ids(orders, 'customer', self.seed),
+            'order_status': status,
+            'order_purchase_timestamp': _timestamps(purchase),
+            'order_approved_at': _timestamps(approved, status != 'created'),
+            'order_delivered_carrier_date': _timestamps(carrier, shipped),
+            'order_delivered_customer_date': _timestamps(delivered, status == 'delivered'),
+            'order_estimated_delivery_date': _timestamps(estimated),
+            'customer_zip_code_prefix': rng.integers(1000, 99990, n_orders),
+            'customer_state': customer_state,
+            'review_score': review_score,
+        })
+        df_order = df_order.merge(self.states, how='left', left_on='customer_state', right_on='state_code')
+        df_order.insert(9, 'customer_city', df_order['state_name'].str.lower())
+
+        # items of popular products, sold by the seller of the product
+        n_items = rng.choice(len(N_ITEMS), n_orders, p=N_ITEMS) + 1
+        item_order = np.repeat(np.arange(n_orders), n_items)
+        product = rng.choice(len(self.product_weights), len(item_order), p=self.product_weights)
+        freight = np.round(rng.gamma(2.5, 8., len(item_order)), 2)
+        df_item = pd.DataFrame({
+            'order_id': df_order['order_id'].to_numpy()[item_order],
+            'order_item_id': _sequence(n_items),
+            'product_id': _ids(product, 'product', self.seed),
+            'seller_id': self.sellers['seller_id'].to_numpy()[self.product_seller[product]],
+            'shipping_limit_date': _timestamps(purchase[item_order] + np.timedelta64(6, 'D')),
+            'price': self.product_price[product],
+            'freight_value': freight,
+            'product_category_name': self.product_category[product],
+        })
+
+        # payments of the order value, split at random between the payments of an order
+        n_payments = rng.choice(len(N_PAYMENTS), n_orders, p=N_PAYMENTS) + 1
+        payment_order = np.repeat(np.arange(n_orders), n_payments)
+        order_value = np.bincount(item_order, weights=self.product_price[product] + freight, minlength=n_orders)
+        split = rng.exponential(1., len(payment_order))
+        split /= np.bincount(payment_order, weights=split)[payment_order]
+        payment_type = rng.choice(list(PAYMENT_TYPE), len(payment_order), p=_shares(PAYMENT_TYPE))
+        installments = np.where(payment_type == 'credit_card', rng.choice(10, len(payment_order)) + 1, 1)
+        df_payment = pd.DataFrame({
+            'order_id': df_order['order_id'].to_numpy()[payment_order],
+            'payment_sequential': _sequence(n_payments),
+            'payment_type': payment_type,
+            'payment_installments': installments,
+            'payment_value': np.round(order_value[payment_order] * split, 2),
+        })
+
+        return {'orders': df_order, 'items': df_item, 'payments': df_payment}
+
+    def sales(self, month):
+        '''facts of the month with the sales table joined from them.
+        '''
+        facts = self.facts(month)
+        facts['sales'] = data.join_facts(facts, {'seller': self.sellers})
+
+        return facts
+
+    def store(self):
+        '''OrderStore of all the orders, built one month at a time as data.consolidate_dataset does.
+        '''
+        store = None
+        for month in self.months:
+            df = self.sales(month)['sales'][config.STORE_COLUMNS]
+            store = data.OrderStore.from_frame(df) if store is None else store.append(df)
+
+        return store
+
+    def write(self, path):
+        '''write the monthly partitions of every fact to path, in the layout of config.DATA_PARTITIONS.
+        '''
+        for month in self.months:
+            facts = self.sales(month)
+            for name in config.FACTS:
+                os.makedirs(os.path.join(path, name), exist_ok=True)
+                facts[name].to_csv(os.path.join(path, name, f'{month}.csv'), index=False)
+
+
+def _product_categories():
+    # share of each category in the real catalog, translated to english
+    df_product = pd.read_csv(config.get_raw_filename(config.DATA_FILES['product']), usecols=['product_category_name'])
+    df_translation = pd.read_csv(config.get_raw_filename(config.DATA_FILES['product_category_translation']))
+    categories = df_product['product_category_name'].map(
+        pd.Series(df_translation['product_category_name_english'].values,
+                  index=df_translation['product_category_name'])).value_counts()
+
+    return categories / categories.sum()
+
+
+def _seller_states():
+    states = pd.read_csv(config.get_raw_filename(config.DATA_FILES['seller']), usecols=['seller_state'])
+    states = states['seller_state'].value_counts()
+
+    return states / states.sum()
+
+
+def _shares(shares):
+    shares = np.array(list(shares.values()))
+    return shares / shares.sum()
+
+
+def _zipf(n, exponent, rng):
+    # probabilities decreasing as a power of the rank, ranks shuffled so that popularity is not the id order
+    weights = 1. / np.arange(1, n + 1) ** exponent
+    return rng.permutation(weights / weights.sum())
+
+
+def _ids(index, kind, seed):
+    # 32 hexadecimal digits as the Olist ids, a different id space per kind of entity
+    salt = int(sketch.hash_values(np.array([seed]))[0]) ^ int.from_bytes(kind.encode()[:8], 'little')
+    index = np.asarray(index, dtype=np.uint64)
+    high = sketch.hash_values(index ^ np.uint64(salt))
+    low = sketch.hash_values(high)
+
+    return np.array([f'{h:016x}{l:016x}' for h, l in zip(high.tolist(), low.tolist())], dtype=object)
+
+
+def _sequence(counts):
+    # 1, 2... within each group of counts rows
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+
+
+def _timestamps(values, present=None):
+    values = np.datetime_as_string(np.asarray(values).astype('datetime64[s]')).astype(object)
+    values = np.char.replace(values.astype(str), 'T', ' ').astype(object)
+    if present is not None:
+        values[~present] = np.nan
+
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write synthetic Olist orders partitioned by month')
+    parser.add_argument('--scale', type=float, default=1., help='multiple of the Olist size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True, help='directory of the partitions')
+    args = parser.parse_args()
+
+    generator = Generator(args.scale, args.seed)
+    generator.write(args.output)
+    print(f'{len(generator)} orders over {len(generator.months)} months written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
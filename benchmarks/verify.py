@@ -0,0 +1,187 @@
+'''Results of the indexes and of the incremental paths of src.data checked against pandas and full rebuilds.
+
+On synthetic orders (see benchmarks.synthetic): bitmap index selections against masks of the codes, store rows and
+cube cells of random filters against data.filter_dataframe, appends of batches ending in the middle of a byte of the
+bitmaps against stores built at once, and ingested batches of new and updated orders against the store and the cube
+rebuilt from scratch.
+
+Run from the repository root with `python -m benchmarks.verify`, exits with status 1 when a check fails.
+'''
+import argparse
+import sys
+import traceback
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from src import config, data
+from .synthetic import Generator
+
+CHECKS = OrderedDict()
+
+
+def check(function):
+    CHECKS[function.__name__] = function
+    return function
+
+
+class Context:
+    '''sales of the synthetic orders, sorted by purchase date as in a store, and the store and cube built from them.
+    '''
+
+    def __init__(self, scale, seed):
+        self.generator = Generator(scale, seed)
+        self.rng = np.random.default_rng(seed)
+        self.sales = pd.concat(
+            [self.generator.sales(month)['sales'][config.STORE_COLUMNS] for month in self.generator.months],
+            ignore_index=True,
+        ).sort_values('order_purchase_timestamp', kind='mergesort', ignore_index=True)
+        self.store = data.OrderStore.from_frame(self.sales)
+        self.cube = data.build_cube(self.store)
+        self.df = self.store.take()
+
+
+def random_values(rng, values):
+    # every value, all but a few (complement path of the bitmaps), a few, or none
+    values = list(values)
+    kind = rng.integers(4)
+    if kind == 0:
+        return values
+    if kind == 1:
+        return list(rng.choice(values, max(len(values) - rng.integers(1, 4), 0), replace=False))
+    if kind == 2:
+        return list(rng.choice(values, min(rng.integers(1, 4), len(values)), replace=False))
+
+    return []
+
+
+def random_signature(rng, store):
+    first, last = store.min_date(), store.max_date()
+    start = first + timedelta(days=int(rng.integers(-10, (last - first).days + 10)))
+    end = start + timedelta(days=int(rng.integers(-5, 400)))
+
+    return data.filter_signature(
+        str(start), str(end), random_values(rng, store.values('payment_type')),
+        random_values(rng, store.values('product_category_name')), random_values(rng, store.values('state_name')),
+    )
+
+
+def decoded(store):
+    # rows of a store as plain values in a canonical order, whatever the codes and the order of the rows
+    df = store.take().astype({name: object for name in config.STORE_CATEGORICAL})
+    return df.sort_values(list(df.columns), kind='mergesort', ignore_index=True)
+
+
+@check
+def bitmap_index(context, n):
+    for name, index in context.store.indexes.items():
+        codes = context.store.columns[name]
+        n_values = len(context.store.dictionaries[name])
+        codes = np.where(codes < 0, n_values, codes)
+
+        for _ in range(n):
+            selected = context.rng.choice(n_values + 1, context.rng.integers(n_values + 2), replace=False)
+            start = int(context.rng.integers(len(codes)))
+            stop = int(context.rng.integers(start, len(codes) + 1))
+
+            bitmap = index.select(selected, start, stop)
+            mask = np.ones(stop - start, dtype=bool) if bitmap is None else data.unpack_bitmap(bitmap, start, stop)
+            assert np.array_equal(mask, np.isin(codes[start:stop], selected)), (name, list(selected), start, stop)
+
+
+@check
+def filters(context, n):
+    for _ in range(n):
+        signature = random_signature(context.rng, context.store)
+        expected = data.filter_dataframe(context.df, *signature)
+
+        rows = np.arange(len(context.store))[context.store.rows(*signature)]
+        assert np.array_equal(rows, expected.index.to_numpy()), signature
+
+        cells = context.cube.cells(*signature)
+        assert context.cube.measures['n_rows'][cells].sum() == len(expected), signature
+        assert np.isclose(context.cube.measures['payment_value'][cells].sum(), expected['payment_value'].sum()), \
+            signature
+
+
+@check
+def append(context, n):
+    # cut where the bitmaps end in the middle of a byte, then append in small batches of any size. Every case builds
+    # stores from scratch, a fifth of the cases are run
+    for _ in range(max(n // 5, 1)):
+        cut = int(context.rng.integers(1, len(context.sales) // 8 - 64)) * 8 + int(context.rng.integers(1, 8))
+        store = data.OrderStore.from_frame(context.sales[:cut])
+        first = cut
+        while cut < len(context.sales):
+            size = int(context.rng.integers(1, 20)) if cut < first + 64 else len(context.sales) - cut
+            store = store.append(context.sales[cut:cut + size])
+            cut += size
+
+            for name, index in store.indexes.items():
+                rebuilt = data.BitmapIndex.from_codes(store.columns[name], len(store.dictionaries[name]))
+                assert np.array_equal(index.bitmaps, rebuilt.bitmaps), (name, len(store))
+
+        pd.testing.assert_frame_equal(decoded(store), decoded(context.store))
+
+
+@check
+def ingest(context, n):
+    last_month = context.generator.months[-1]
+    base = context.sales[context.sales['order_purchase_timestamp'] < str(last_month)]
+    for distinct in ('exact', 'hll'):
+        for _ in range(max(n // 5, 1)):
+            # new orders of the last month, and earlier orders updated with all their rows
+            orders = base['order_id'].unique()
+            updated = context.rng.choice(orders, min(len(orders), 50), replace=False)
+            changes = base[base['order_id'].isin(updated)].assign(
+                payment_value=lambda df: df['payment_value'] * 2., order_status='canceled')
+            batch = pd.concat([context.sales[context.sales['order_purchase_timestamp'] >= str(last_month)], changes])
+
+            store = data.OrderStore.from_frame(base)
+            store, cube = data.append_orders(store, data.build_cube(store, distinct), batch,
+                                             batch['order_id'].unique())
+
+            rebuilt = data.OrderStore.from_frame(pd.concat([base[~base['order_id'].isin(updated)], batch]))
+            pd.testing.assert_frame_equal(decoded(store), decoded(rebuilt))
+
+            full = data.build_cube(store, distinct)
+            for arrays, rebuilt_arrays in ((cube.dimensions, full.dimensions), (cube.measures, full.measures)):
+                for name, values in arrays.items():
+                    assert np.allclose(values, rebuilt_arrays[name]), (distinct, name)
+            for name, (offsets, members) in cube.distinct.items():
+                assert np.array_equal(offsets, full.distinct[name][0]), (distinct, name)
+                assert np.array_equal(members, full.distinct[name][1]), (distinct, name)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=.2, help='size as a multiple of the Olist dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20, help='random cases of every check')
+    parser.add_argument('--only', nargs='+', help='run these checks only')
+    args = parser.parse_args()
+
+    context = Context(args.scale, args.seed)
+    print(f'{len(context.store)} rows', file=sys.stderr)
+
+    failed = []
+    for name, function in CHECKS.items():
+        if args.only and name not in args.only:
+            continue
+
+        try:
+            function(context, args.repeat)
+            print(f'{name}: ok')
+        except AssertionError:
+            traceback.print_exc()
+            print(f'{name}: FAILED')
+            failed.append(name)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from . import config, jobs, metrics
+
+
+def digest(key):
+    '''stable digest of a key made of strings, numbers and tuples of them, the same in every process.
+    '''
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+class ResultCache:
+    '''bounded LRU of results in the process, optionally backed by a store shared with the other processes.
+
+    Keys are digested so that equal keys hit the same entry in every process. Values must be picklable when a
+    shared store is used. Hits and misses are counted in the metrics under name.
+    '''
+
+    def __init__(self, max_size=None, shared=None, name='outputs'):
+        self.max_size = max_size or config.OUTPUT_CACHE_SIZE
+        self.shared = shared
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''(found, value) of the entry of key.
+        '''
+        key = digest(key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.cache_request(self.name, True)
+                return True, self._entries[key]
+
+        if self.shared is not None:
+            found, value = self.shared.get(key)
+            metrics.cache_request(f'{self.name}_shared', found)
+            if found:
+                self._set(key, value)
+                metrics.cache_request(self.name, True)
+                return True, value
+
+        metrics.cache_request(self.name, False)
+        return False, None
+
+    def set(self, key, value):
+        key = digest(key)
+        self._set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def _set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        '''value of key, computed and stored when missing unless cacheable tells that it should not be kept.
+
+        With a shared store, a missing value is computed by one process at a time: the others wait for it to be
+        stored, or compute it themselves when it is not cacheable.
+        '''
+        found, value = self.get(key)
+        if found:
+            return value
+        if self.shared is None:
+            return self._compute(key, compute, cacheable)
+
+        shared_key = digest(key)
+        while not self.shared.lock(shared_key):
+            jobs.checkpoint()
+            time.sleep(config.OUTPUT_CACHE_LOCK_POLL)
+            found, value = self.shared.get(shared_key)
+            if found:
+                self._set(shared_key, value)
+                return value
+
+        try:
+            # stored by another process between the miss and the lock
+            found, value = self.shared.get(shared_key)
+            if found:
+                self._set(shared_key, value)
+                return value
+            return self._compute(key, compute, cacheable)
+        finally:
+            self.shared.unlock(shared_key)
+
+    def _compute(self, key, compute, cacheable):
+        value = compute()
+        if cacheable is None or cacheable(value):
+            self.set(key, value)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileStore:
+    '''values pickled to one file per key in a directory shared by the processes of the application.
+
+    Files are written aside and renamed so that readers never see a partial value. When the directory holds more
+    than max_size files, the least recently written ones are removed. The directory is only scanned when the count
+    of files, kept by each process from its own writes since its last scan, passes max_size: writes of the other
+    processes are not counted, so the directory may exceed max_size by their writes until the next scan.
+
+    lock and unlock mark a key being computed with a lock file, left behind locks expire after
+    config.OUTPUT_CACHE_LOCK_TIMEOUT seconds.
+    '''
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or config.DIR_CACHE
+        self.max_size = max_size or config.OUTPUT_CACHE_SHARED_SIZE
+        os.makedirs(self.directory, exist_ok=True)
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, f'{key}.pkl'), 'rb') as f:
+                return True, pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def set(self, key, value):
+        filename = os.path.join(self.directory, f'{key}.pkl')
+        tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+
+        with self._lock:
+            # overwrites are counted as new files, they only bring the next scan forward
+            self._size = self._size + 1 if self._size is not None else self._scan()
+            if self._size > self.max_size:
+                self._size = self._evict()
+
+    def lock(self, key):
+        '''True when the lock file of key was created by this call, False when another one holds it.
+        '''
+        filename = os.path.join(self.directory, f'{key}.lock')
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL))
+            return True
+        except FileExistsError:
+            pass
+
+        # take over the locks of the processes that died
+        try:
+            if time.time() - os.path.getmtime(filename) > config.OUTPUT_CACHE_LOCK_TIMEOUT:
+                os.remove(filename)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def unlock(self, key):
+        try:
+            os.remove(os.path.join(self.directory, f'{key}.lock'))
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.pkl')]
+
+    def _scan(self):
+        return len(self._entries())
+
+    def _evict(self):
+        # number of files left. The oldest tenth is dropped at once so that the next scan is max_size / 10 writes away
+        entries = self._entries()
+        if len(entries) <= self.max_size:
+            return len(entries)
+
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        n_removed = len(entries) - self.max_size + self.max_size // 10
+        for entry in entries[:n_removed]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+        return len(entries) - n_removed
+
+
+def make_cache():
+    '''result cache configured by config.OUTPUT_CACHE_SIZE and config.OUTPUT_CACHE_SHARED.
+    '''
+    shared = FileStore() if config.OUTPUT_CACHE_SHARED == 'filesystem' else None
+    return ResultCache(shared=shared)
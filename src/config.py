@@ -7,6 +7,11 @@ DIR_ROOT = str(Path(os.path.abspath(__file__)).parents[1])
 DIR_DATA = os.path.join(DIR_ROOT, 'data/')
 DIR_DATA_RAW = os.path.join(DIR_DATA, 'raw/')
 DIR_DATA_PROCESSED = os.path.join(DIR_DATA, 'processed/')
+DIR_FORECAST = os.path.join(DIR_DATA_PROCESSED, 'forecasts/')
+DIR_INGEST = os.path.join(DIR_DATA, 'ingest/')
+DIR_CACHE = os.path.join(DIR_DATA_PROCESSED, 'cache/')
+DIR_PROFILES = os.path.join(DIR_DATA, 'profiles/')
+DIR_TRAFFIC = os.path.join(DIR_DATA, 'traffic/')
 
 DATA_FILES = {
     'customer': 'olist_customers_dataset.csv',
@@ -20,6 +25,33 @@ DATA_FILES = {
     'product_category_translation': 'product_category_name_translation.csv',
 }
 
+# directories of the binary, memory-mappable order store and cube written next to the processed orders
+DATA_STORE = 'olist_orders_store'
+DATA_CUBE = 'olist_orders_cube'
+DATA_VERSION = 'olist_orders_version'
+
+# monthly partitions of the consolidated orders, one CSV per fact and month of purchase
+DATA_PARTITIONS = 'olist_orders_partitions'
+
+# normalized facts of the orders: one row per order, per item and per payment, joined on order_id into the sales
+# table served by the application. Columns of the payment and item facts in the consolidated tables, the other ones
+# describe the order.
+FACTS = ['orders', 'items', 'payments', 'sales']
+FACT_PAYMENT = ['payment_sequential', 'payment_type', 'payment_installments', 'payment_value']
+FACT_ITEM = ['order_item_id', 'product_id', 'seller_id', 'shipping_limit_date', 'price', 'freight_value',
+             'product_category_name']
+
+# orders kept by consolidate_dataset: purchase timestamps between the two dates (compared as strings, the end date
+# stops at its midnight) and rows of the raw tables read at once
+CONSOLIDATE_START_DATE = '2018-01-01'
+CONSOLIDATE_END_DATE = '2018-08-09'
+CONSOLIDATE_CHUNK_SIZE = 100000
+
+# seconds between two checks of the running application for a new dataset version or queued order batches, and
+# after which a process ingesting the queue is considered dead
+RELOAD_INTERVAL = 60
+INGEST_LOCK_TIMEOUT = 600
+
 COLUMN_DATE = [
     'order_purchase_timestamp',
     'order_approved_at',
@@ -28,6 +60,127 @@ COLUMN_DATE = [
     'order_estimated_delivery_date'
 ]
 
+# columns of the consolidated orders kept in memory by the application
+STORE_CATEGORICAL = [
+    'order_id',
+    'customer_id',
+    'seller_id',
+    'order_status',
+    'payment_type',
+    'product_category_name',
+    'customer_state',
+    'state_name',
+]
+
+STORE_DATE = [
+    'order_purchase_timestamp',
+]
+
+STORE_NUMERIC = {
+    'payment_value': 'float64',
+    'review_score': 'float32',
+    'lat': 'float64',
+    'long': 'float64',
+}
+
+STORE_COLUMNS = STORE_CATEGORICAL + STORE_DATE + list(STORE_NUMERIC)
+
+# categorical columns with a bitmap index, the dimensions the dashboard filters on
+STORE_INDEXED = [
+    'order_status',
+    'payment_type',
+    'product_category_name',
+    'state_name',
+]
+
+# period of the partitions of the store and the cube rows ('M' for months, 'D' for days, any numpy datetime unit)
+# whose statistics let selections skip the periods that cannot match
+PARTITION_PERIOD = 'M'
+
+# grain and measures of the daily cube pre-aggregated from the orders
+CUBE_DIMENSIONS = [
+    'payment_type',
+    'product_category_name',
+    'state_name',
+    'order_status',
+]
+
+CUBE_SUM = [
+    'payment_value',
+]
+
+CUBE_DISTINCT = [
+    'order_id',
+    'customer_id',
+    'seller_id',
+]
+
+# distinct counts (orders, customers, sellers) are either 'exact' or estimated with HyperLogLog sketches ('hll')
+# whose relative standard error is HLL_ERROR
+DISTINCT_COUNT = 'exact'
+HLL_ERROR = 0.01
+
+# sales forecast: ARIMA order, number of days forecasted and seconds after which a process fitting a forecast is
+# considered dead
+FORECAST_ORDER = (9, 0, 1)
+FORECAST_LOOK_AHEAD = 15
+FORECAST_LOCK_TIMEOUT = 600
+
+# forecasts of filtered sales: shortest series fitted, number of memoized forecasts and their lifetime in seconds
+# (FORECAST_FAILURE_TTL for failed fits, retried after it), threads fitting them
+FORECAST_MIN_DAYS = 60
+FORECAST_CACHE_SIZE = 128
+FORECAST_CACHE_TTL = 24 * 3600
+FORECAST_FAILURE_TTL = 300
+FORECAST_WORKERS = 2
+
+# batch forecasts of the daily revenue of every state x product category: estimator ('ls' for AR least squares
+# fitted on all series at once, 'css' for the statsmodels ARIMA of each series), AR order of the least squares
+# estimator and processes sharing the series
+FORECAST_BATCH_BY = ['state_name', 'product_category_name']
+FORECAST_BATCH_METHOD = 'ls'
+FORECAST_BATCH_AR_ORDER = 10
+FORECAST_BATCH_PROCESSES = os.cpu_count()
+
+# outputs of the dashboard callbacks cached per data version and filters: entries kept by each process and, when
+# OUTPUT_CACHE_SHARED is 'filesystem', files shared by the processes under DIR_CACHE (None to disable)
+OUTPUT_CACHE_SIZE = 256
+OUTPUT_CACHE_SHARED = None
+OUTPUT_CACHE_SHARED_SIZE = 4096
+# processes missing the same shared output wait for the one computing it, checking every OUTPUT_CACHE_LOCK_POLL
+# seconds, unless its lock is older than OUTPUT_CACHE_LOCK_TIMEOUT seconds
+OUTPUT_CACHE_LOCK_POLL = 0.05
+OUTPUT_CACHE_LOCK_TIMEOUT = 60
+
+# aggregation engine: selections of at least twice AGGREGATE_PARTITION_ROWS rows or cells are split in partitions
+# aggregated in parallel by the AGGREGATE_WORKERS threads shared by the requests of each process
+AGGREGATE_WORKERS = os.cpu_count()
+AGGREGATE_PARTITION_ROWS = 100000
+
+# heavy panels (states, sellers and product categories) computed as background jobs by JOB_WORKERS threads of each
+# process instead of within their callback, their page polls the job every JOB_POLL_INTERVAL milliseconds and the
+# jobs of a page that stopped polling for JOB_TTL seconds are cancelled
+BACKGROUND_PANELS = True
+JOB_WORKERS = 2
+JOB_POLL_INTERVAL = 250
+JOB_TTL = 30
+
+# figures: daily series are downsampled (LTTB) to PLOT_POINTS_PER_PIXEL points per pixel of the part of a graph
+# PLOT_WIDTH pixels wide they span, and whether numeric arrays are shipped as base64 typed arrays, decoded in the
+# browser by assets/figures.js
+PLOT_WIDTH = 1000
+PLOT_POINTS_PER_PIXEL = 1
+PLOT_TYPED_ARRAYS = False
+
+# instrumentation: prefix of the metrics served on /metrics, and whether requests asking for it (X-Profile header or
+# profile cookie) are profiled by sampling their stack every PROFILER_INTERVAL seconds, saved under DIR_PROFILES
+METRICS_PREFIX = 'dashboard_'
+PROFILER = False
+PROFILER_INTERVAL = 0.005
+
+# log the callback requests to DIR_TRAFFIC, sessions replayed by the load tests are recorded from these logs
+TRAFFIC_LOG = False
+
 STATES = os.path.join(DIR_DATA_RAW, 'states.csv')
 
 ORDER_STATUS_CONSO = [
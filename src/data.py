@@ -1,59 +1,383 @@
+import functools
+import glob
+import hashlib
+import json
+import shutil
+import os
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 
-from . import config
+from . import config, jobs, metrics, parallel, sketch
 
 
-def consolidate_dataset():
+def consolidate_dataset(start_date=None, end_date=None, chunk_size=None):
     '''helper function to generate the dataset. It is not used in the application.
+
+    Orders purchased between start_date and end_date (config.CONSOLIDATE_START_DATE and CONSOLIDATE_END_DATE by
+    default) are consolidated one month at a time: the raw tables are streamed by chunks of chunk_size rows and split
+    by month of purchase, then each month is joined with the dimension tables, written to its partition of each fact
+    and appended to the binary store. Memory is bounded by the size of a month instead of the whole history.
     '''
-    # load datasets
-    df_order = pd.read_csv(config.get_raw_filename(config.DATA_FILES['order']))
-    df_order_item = pd.read_csv(config.get_raw_filename(config.DATA_FILES['order_item']))
-    df_order_payment = pd.read_csv(config.get_raw_filename(config.DATA_FILES['order_payment']))
-    df_order_review = pd.read_csv(config.get_raw_filename(config.DATA_FILES['order_review']))
+    start_date = start_date or config.CONSOLIDATE_START_DATE
+    end_date = end_date or config.CONSOLIDATE_END_DATE
+    chunk_size = chunk_size or config.CONSOLIDATE_CHUNK_SIZE
 
-    df_customer = pd.read_csv(config.get_raw_filename(config.DATA_FILES['customer']))
-    df_product = pd.read_csv(config.get_raw_filename(config.DATA_FILES['product']))
-    df_product_category_translation = pd.read_csv(
-        config.get_raw_filename(config.DATA_FILES['product_category_translation']))
-    df_seller = pd.read_csv(config.get_raw_filename(config.DATA_FILES['seller']))
-    df_states = pd.read_csv(config.STATES)
+    path = config.get_processed_filename(config.DATA_PARTITIONS)
+    tmp = _temporary_directory(path)
+    staging = os.path.join(tmp, 'staging')
+    columns = {}
+
+    # month of purchase of the orders in the window, the only column kept for the whole history
+    months = []
+    for chunk in _read_raw('order', chunk_size, columns):
+        timestamps = chunk['order_purchase_timestamp']
+        chunk = chunk[(timestamps >= start_date) & (timestamps <= end_date)]
+        month = chunk['order_purchase_timestamp'].str[:7]
+        _stage(chunk, month, os.path.join(staging, 'order'))
+        months.append(pd.Series(month.to_numpy(), index=chunk['order_id'].to_numpy()))
+    months = pd.concat(months).astype('category') if months else pd.Series(dtype=object)
+
+    for name in ('order_item', 'order_payment', 'order_review'):
+        for chunk in _read_raw(name, chunk_size, columns):
+            month = chunk['order_id'].map(months).astype(object)
+            _stage(chunk[month.notna()], month.dropna(), os.path.join(staging, name))
+
+    dimensions = load_dimensions()
+    store = None
+    for month in sorted(months.unique()):
+        facts = order_facts(*[
+            _read_staged(os.path.join(staging, name), month, columns[name])
+            for name in ('order', 'order_item', 'order_payment', 'order_review')
+        ], dimensions)
+        facts['sales'] = df_order = join_facts(facts, dimensions)
+        if df_order.empty:
+            continue
+
+        for name in config.FACTS:
+            os.makedirs(os.path.join(tmp, name), exist_ok=True)
+            facts[name].to_csv(os.path.join(tmp, name, f'{month}.csv'), index=False)
+
+        df_order = df_order[config.STORE_COLUMNS]
+        store = OrderStore.from_frame(df_order) if store is None else store.append(df_order)
+
+    shutil.rmtree(staging, ignore_errors=True)
+    if store is None:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise ValueError(f'no orders between {start_date} and {end_date}')
+
+    _replace_directory(tmp, path)
+
+    # binary copies memory-mapped by the application
+    save_dataset(store, build_cube(store))
+
+
+def _read_raw(name, chunk_size, columns):
+    for chunk in pd.read_csv(config.get_raw_filename(config.DATA_FILES[name]), chunksize=chunk_size):
+        columns[name] = chunk.columns
+        yield chunk
+
+
+def _stage(df, month, path):
+    # append the rows to the staging file of their month
+    os.makedirs(path, exist_ok=True)
+    for value, df_month in df.groupby(month.to_numpy()):
+        filename = os.path.join(path, f'{value}.csv')
+        df_month.to_csv(filename, mode='a', header=not os.path.exists(filename), index=False)
+
+
+def _read_staged(path, month, columns):
+    filename = os.path.join(path, f'{month}.csv')
+    if not os.path.exists(filename):
+        return pd.DataFrame(columns=columns)
+
+    return pd.read_csv(filename)
 
-    # filter data to keep only 2018
-    df_order = df_order[(df_order['order_purchase_timestamp'] >= '2018-01-01') & (df_order['order_purchase_timestamp'] <= '2018-08-09')]
-    df_order_item = df_order_item[df_order_item['order_id'].isin(df_order['order_id'].unique())]
-    df_order_payment = df_order_payment[df_order_payment['order_id'].isin(df_order['order_id'].unique())]
-    df_order_review = df_order_review[df_order_review['order_id'].isin(df_order['order_id'].unique())]
 
-    df_customer = df_customer[df_customer['customer_id'].isin(df_order['customer_id'].unique())]
+@functools.lru_cache(maxsize=1)
+def load_dimensions():
+    '''customer, product (with english category names), seller and state tables the orders are joined with.
+    '''
+    df_customer = pd.read_csv(config.get_raw_filename(config.DATA_FILES['customer']))
     df_customer = df_customer.drop('customer_unique_id', axis=1)
 
-    df_order_review = df_order_review[['order_id', 'review_score']]
-    df_product = df_product[df_product['product_id'].isin(df_order_item['product_id'].unique())]
+    df_product = pd.read_csv(config.get_raw_filename(config.DATA_FILES['product']))
+    df_product_category_translation = pd.read_csv(
+        config.get_raw_filename(config.DATA_FILES['product_category_translation']))
     df_product = df_product.loc[:, ['product_id', 'product_category_name']]
     df_product['product_category_name'] = df_product['product_category_name'].map(
         pd.Series(df_product_category_translation['product_category_name_english'].values,
                   index=df_product_category_translation['product_category_name']).to_dict())
 
-    df_seller = df_seller[df_seller['seller_id'].isin(df_order_item['seller_id'].unique())]
+    return {
+        'customer': df_customer,
+        'product': df_product,
+        'seller': pd.read_csv(config.get_raw_filename(config.DATA_FILES['seller'])),
+        'states': pd.read_csv(config.STATES),
+    }
 
-    # merge to one dataset
-    df_order = df_order.merge(df_customer, how='left', on='customer_id')
-    df_order = df_order.merge(df_order_payment, how='left', on='order_id')
-    df_order = df_order.merge(df_order_item, how='left', on='order_id')
+
+def join_orders(df_order, df_order_item, df_order_payment, df_order_review, dimensions):
+    '''merge orders with their payments, items and reviews and the dimension tables to one consolidated dataset.
+    '''
+    return join_facts(order_facts(df_order, df_order_item, df_order_payment, df_order_review, dimensions), dimensions)
+
+
+def order_facts(df_order, df_order_item, df_order_payment, df_order_review, dimensions):
+    '''normalized facts of the orders: orders with their customer and review score, items with their product
+    category and payments, the last two referencing the orders by order_id.
+    '''
+    df_order_review = df_order_review.groupby('order_id', as_index=False)['review_score'].mean()
+
+    df_order = df_order.merge(dimensions['customer'], how='left', on='customer_id')
     df_order = df_order.merge(df_order_review, how='left', on='order_id')
-    df_order = df_order.merge(df_product, how='left', on='product_id')
-    df_order = df_order.merge(df_seller, how='left', on='seller_id')
-    df_order = df_order.merge(df_states, how='left', left_on='customer_state', right_on='state_code',
+    df_order = df_order.merge(dimensions['states'], how='left', left_on='customer_state', right_on='state_code',
                               suffixes=('', '_customer'))
 
-    df_order = df_order.dropna(subset=['payment_type', 'product_category_name', 'seller_state', 'customer_state'])
-    df_order.to_csv(config.get_processed_filename(config.DATA_FILES['order']), index=False)
+    return {
+        'orders': df_order,
+        'items': df_order_item.merge(dimensions['product'], how='left', on='product_id'),
+        'payments': df_order_payment,
+    }
+
+
+@metrics.timed('join')
+def join_facts(facts, dimensions):
+    '''sales of the orders: one row per payment and per category and seller of the items of the order.
+
+    Joining payments and items on the order would repeat each payment for every item. Instead the items of an order
+    are grouped by category and seller and every payment is allocated to the groups in proportion of their value
+    (price and freight), so that summing payment_value over any selection never exceeds what was paid.
+    '''
+    df_item = facts['items']
+    value = df_item['price'] + df_item['freight_value']
+    order_value = value.groupby(df_item['order_id']).transform('sum')
+    n_items = df_item.groupby('order_id')['order_id'].transform('size')
+
+    df_item = df_item.assign(share=np.where(order_value > 0, value / order_value, 1. / n_items), n_items=1)
+    df_item = df_item.groupby(['order_id', 'product_category_name', 'seller_id'], sort=False, as_index=False)[
+        ['share', 'price', 'freight_value', 'n_items']].sum()
+
+    df_order = facts['orders'].merge(facts['payments'], how='left', on='order_id')
+    df_order = df_order.merge(df_item, how='left', on='order_id')
+    df_order = df_order.merge(dimensions['seller'], how='left', on='seller_id')
+    df_order['payment_value'] = df_order['payment_value'] * df_order.pop('share')
+
+    return df_order.dropna(subset=['payment_type', 'product_category_name', 'seller_state', 'customer_state'])
+
+
+def split_consolidated(df):
+    '''facts and seller dimension of a consolidated dataset written before the fact model, whose rows are the
+    cartesian product of the payments and the items of each order.
+    '''
+    payment, item = config.FACT_PAYMENT, config.FACT_ITEM
+    seller = [name for name in df.columns if name.startswith('seller_')]
+    order = [name for name in df.columns if name not in payment + item + seller]
+
+    facts = {
+        'orders': df.drop_duplicates('order_id')[order],
+        'items': df.drop_duplicates(['order_id', 'order_item_id'])[['order_id'] + item],
+        'payments': df.drop_duplicates(['order_id', 'payment_sequential'])[['order_id'] + payment],
+    }
+
+    return facts, {'seller': df.drop_duplicates('seller_id')[seller]}
+
+
+def ingest(store, cube, df_order, df_order_item, df_order_payment, df_order_review, df_customer=None):
+    '''add a batch of new or updated orders to the store and the cube without rebuilding them.
+
+    The batch holds, for every order it touches, the order and all its items, payments and reviews in the raw
+    Olist layout. Only the batch is joined with the cached dimension tables, extended with df_customer for new
+    customers. Orders already in the store are replaced. Returns the new store and cube, the given ones are left
+    untouched so that readers can keep using them.
+    '''
+    dimensions = load_dimensions()
+    if df_customer is not None:
+        dimensions['customer'] = pd.concat([dimensions['customer'], df_customer.drop('customer_unique_id', axis=1)])
+        dimensions['customer'] = dimensions['customer'].drop_duplicates('customer_id', keep='last')
+
+    df = join_orders(df_order, df_order_item, df_order_payment, df_order_review, dimensions)
+
+    return append_orders(store, cube, df, df_order['order_id'].unique())
+
+
+def append_orders(store, cube, df, orders):
+    '''new store and cube holding the sales rows of df, which replace the rows of the given orders when the store
+    holds them already.
+    '''
+    updated = np.intersect1d(orders, store.dictionaries['order_id'])
+
+    # days whose cells change: the days of the new rows and of the replaced ones
+    days = np.union1d(
+        to_epoch_day(df['order_purchase_timestamp']),
+        store.columns['order_purchase_timestamp'][store.isin('order_id', updated)],
+    )
+    store = store.append(df, updated)
+
+    return store, cube.update(store, days)
+
+
+def save_dataset(store, cube):
+    '''save the store and the cube, then publish their version to the running applications.
+    '''
+    store.save(config.get_processed_filename(config.DATA_STORE))
+    cube.save(config.get_processed_filename(config.DATA_CUBE))
+
+    filename = config.get_processed_filename(config.DATA_VERSION)
+    with open(f'{filename}.tmp', 'w') as f:
+        f.write(store.version)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def saved_version():
+    '''version of the last dataset saved by save_dataset, None when there is none.
+    '''
+    try:
+        with open(config.get_processed_filename(config.DATA_VERSION)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def load_store():
+    '''memory-map the binary order store written by consolidate_dataset, or build it from the processed partitions
+    or CSV.
+    '''
+    path = config.get_processed_filename(config.DATA_STORE)
+    if os.path.isdir(path):
+        return OrderStore.load(path)
+
+    path = config.get_processed_filename(config.DATA_PARTITIONS)
+    if os.path.isdir(path):
+        filenames = sorted(glob.glob(os.path.join(path, 'sales', '*.csv')))
+        return OrderStore.from_frame(pd.concat([
+            pd.read_csv(filename, usecols=config.STORE_COLUMNS) for filename in filenames
+        ], ignore_index=True))
+
+    # single CSV of the first versions, payments repeated for every item of their order
+    facts, dimensions = split_consolidated(pd.read_csv(config.get_processed_filename(config.DATA_FILES['order'])))
+    return OrderStore.from_frame(join_facts(facts, dimensions)[config.STORE_COLUMNS])
+
+
+def load_cube(store):
+    '''memory-map the binary cube written by consolidate_dataset, or build it from the store when it is missing or
+    was built from another version of the store.
+    '''
+    path = config.get_processed_filename(config.DATA_CUBE)
+    if os.path.isdir(path):
+        cube = OrderCube.load(path, store.dictionaries)
+        if cube.version == store.version:
+            return cube
+
+    return build_cube(store)
+
+
+def build_cube(store, distinct=None):
+    '''pre-aggregate the orders of an OrderStore to one cell per day and combination of the cube dimensions.
+
+    Cells hold the sum of the measures, the number of rows and, for the distinct-count columns, either the distinct
+    codes present in the cell (distinct='exact') or a sparse HyperLogLog sketch of them (distinct='hll'), both
+    mergeable across cells. distinct defaults to config.DISTINCT_COUNT.
+    '''
+    distinct_count = distinct or config.DISTINCT_COUNT
+    p = sketch.precision(config.HLL_ERROR) if distinct_count == 'hll' else None
+
+    dimensions, measures, distinct = _aggregate(store, slice(None), p)
+
+    return OrderCube(dimensions, measures, distinct, store.dictionaries, _state_attributes(store), p, store.version)
+
 
+def _aggregate(store, rows, p):
+    # cells of the given rows of the store, distinct counts are sketched when the precision p is given
+    days = store.columns['order_purchase_timestamp'][rows]
+    first_day = days.min() if len(days) else 0
 
+    # one integer key per row, day first so that cells come out sorted by day
+    coordinates = [days - first_day] + [
+        store.columns[name][rows].astype(np.int64) + 1 for name in config.CUBE_DIMENSIONS
+    ]
+    shape = [int(days.max() - first_day) + 1 if len(days) else 1] + [
+        len(store.dictionaries[name]) + 1 for name in config.CUBE_DIMENSIONS
+    ]
+    keys, cell = np.unique(np.ravel_multi_index(coordinates, shape), return_inverse=True)
+    coordinates = np.unravel_index(keys, shape)
+    n_cells = len(keys)
+
+    dimensions = {'order_purchase_timestamp': coordinates[0] + first_day}
+    for name, codes in zip(config.CUBE_DIMENSIONS, coordinates[1:]):
+        dimensions[name] = (codes - 1).astype(store.columns[name].dtype)
+
+    measures = {'n_rows': np.bincount(cell, minlength=n_cells)}
+    for name in config.CUBE_SUM:
+        measures[name] = np.bincount(cell, weights=store.columns[name][rows], minlength=n_cells)
+
+    distinct = {}
+    for name in config.CUBE_DISTINCT:
+        if p is None:
+            distinct[name] = _distinct_members(cell, store.columns[name][rows], n_cells,
+                                               len(store.dictionaries[name]))
+        else:
+            distinct[name] = _distinct_sketches(cell, store.columns[name][rows], n_cells, p)
+
+    return dimensions, measures, distinct
+
+
+def _expand(starts, lengths):
+    # concatenation of the ranges start to start + length
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(lengths.sum()) + shift
+
+
+def _gather(values, starts, lengths):
+    # concatenation of the slices values[start:start + length]
+    return values[_expand(starts, lengths)]
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return offsets
+
+
+def _distinct_members(cell, codes, n_cells, n_values):
+    # distinct (cell, code) pairs laid out as offsets into the codes of each cell
+    valid = codes >= 0
+    pairs = np.unique(cell[valid].astype(np.int64) * n_values + codes[valid])
+    cells, members = np.divmod(pairs, n_values)
+
+    return _offsets(np.bincount(cells, minlength=n_cells)), members.astype(codes.dtype)
+
+
+def _distinct_sketches(cell, codes, n_cells, p):
+    # highest rank per (cell, register) laid out as offsets into the entries of each cell, an entry packs the
+    # register and its rank as register << 6 | rank
+    valid = codes >= 0
+    register, rank = sketch.registers(sketch.hash_values(codes[valid]), p)
+    keys = cell[valid].astype(np.int64) * 2 ** p + register
+
+    order = np.lexsort((rank, keys))
+    keys, rank = keys[order], rank[order]
+    last = np.append(keys[1:] != keys[:-1], True)
+    cells, register = np.divmod(keys[last], 2 ** p)
+
+    return _offsets(np.bincount(cells, minlength=n_cells)), (register << 6 | rank[last]).astype(np.int32)
+
+
+def _state_attributes(store):
+    # customer state code and coordinates of each state name
+    codes, rows = np.unique(store.columns['state_name'], return_index=True)
+    rows, codes = rows[codes >= 0], codes[codes >= 0]
+
+    return pd.DataFrame({
+        'customer_state': store.dictionaries['customer_state'][store.columns['customer_state'][rows]],
+        'state_name': store.dictionaries['state_name'][codes],
+        'lat': store.columns['lat'][rows],
+        'long': store.columns['long'][rows],
+    }, index=codes)
+
+
+@metrics.timed('filter', rows=0)
 def filter_dataframe(df, start_date, end_date, payment_type, product_category, customer_state):
     start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
     end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
@@ -69,6 +393,836 @@ def filter_dataframe(df, start_date, end_date, payment_type, product_category, c
     return dff
 
 
+def filter_signature(start_date, end_date, payment_type, product_category, customer_state):
+    '''normalize the filter inputs to a hashable key so equivalent selections share cached results.
+    '''
+    return (
+        start_date[:10],
+        end_date[:10],
+        tuple(sorted(payment_type or [])),
+        tuple(sorted(product_category or [])),
+        tuple(sorted(customer_state or [])),
+    )
+
+
+def to_epoch_day(values):
+    '''convert dates (strings, datetimes or a datetime Series) to int64 days since 1970-01-01.
+    '''
+    return np.asarray(pd.to_datetime(values), dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+
+
+def _code_dtype(n_values):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_values < np.iinfo(dtype).max:
+            return dtype
+
+    return np.int64
+
+
+def unpack_bitmap(bitmap, start, stop):
+    '''boolean mask of rows start to stop from a packed bitmap covering the bytes that hold them.
+    '''
+    offset = start % 8
+
+    return np.unpackbits(bitmap, count=offset + stop - start)[offset:].view(bool)
+
+
+class BitmapIndex:
+    '''one packed bitmap per value of a dictionary-encoded column, plus one for missing values.
+
+    Selections OR the bitmaps of the selected values, or, when most values are selected, OR the few unselected ones
+    and invert the result. Selecting every value costs nothing. A selection can be restricted to a range of rows, it
+    then only touches the bytes covering that range.
+    '''
+
+    def __init__(self, bitmaps, n_rows):
+        self.bitmaps = bitmaps
+        self.n_rows = n_rows
+        self.n_values = len(bitmaps) - 1
+        self.has_missing = bool(bitmaps[-1].any())
+
+    @classmethod
+    def from_codes(cls, codes, n_values):
+        # missing values (code -1) are mapped to the last bitmap
+        codes = np.where(codes < 0, n_values, codes)
+
+        return cls(np.stack([np.packbits(codes == v) for v in range(n_values + 1)]), len(codes))
+
+    def restricts(self, codes):
+        '''whether selecting the given codes leaves some rows out.
+        '''
+        # selecting the code of missing values (n_values) leaves out the rows of any value not selected
+        codes = np.unique(codes)
+
+        if np.count_nonzero(codes < self.n_values) < self.n_values:
+            return True
+
+        return self.has_missing and self.n_values not in codes
+
+    def append(self, codes, n_values):
+        '''index extended with rows holding the given codes, n_values being the new size of the dictionary.
+        '''
+        appended = BitmapIndex.from_codes(codes, n_values)
+
+        # bitmaps of the values added to the dictionary are empty so far, missing values stay last
+        bitmaps = np.concatenate([
+            self.bitmaps[:-1],
+            np.zeros((n_values - self.n_values, self.bitmaps.shape[1]), dtype=np.uint8),
+            self.bitmaps[-1:],
+        ])
+
+        # the last byte may be partially filled, pack it again with the first appended rows
+        tail = self.n_rows % 8
+        if tail:
+            bits = np.concatenate([
+                np.unpackbits(bitmaps[:, -1:], axis=1)[:, :tail],
+                np.unpackbits(appended.bitmaps, axis=1)[:, :len(codes)],
+            ], axis=1)
+            bitmaps = np.concatenate([bitmaps[:, :-1], np.packbits(bits, axis=1)], axis=1)
+        else:
+            bitmaps = np.concatenate([bitmaps, appended.bitmaps], axis=1)
+
+        return BitmapIndex(bitmaps, self.n_rows + len(codes))
+
+    def select(self, codes, start=0, stop=None):
+        '''packed bitmap of the rows holding one of the given codes, None when every row matches.
+
+        The bitmap covers the bytes holding rows start to stop, see unpack_bitmap.
+        '''
+        if not self.restricts(codes):
+            return None
+
+        selected = np.zeros(self.n_values + 1, dtype=bool)
+        selected[codes] = True
+        n_selected = selected.sum()
+
+        stop = self.n_rows if stop is None else stop
+        bitmaps = self.bitmaps[:, start // 8:(stop + 7) // 8]
+
+        if n_selected <= self.n_values // 2:
+            return np.bitwise_or.reduce(bitmaps[selected], axis=0)
+
+        return ~np.bitwise_or.reduce(bitmaps[~selected], axis=0)
+
+
+class Partitions:
+    '''statistics of the partitions of rows sorted by day, one per config.PARTITION_PERIOD: their bounds, first and
+    last day and, for each dimension, the codes present (missing values last, as in BitmapIndex).
+
+    A selection only keeps the partitions overlapping its dates that hold one of the selected codes of every
+    dimension, the rows of the others are never touched.
+    '''
+
+    def __init__(self, bounds, days, present):
+        self.bounds = bounds
+        self.days = days
+        self.present = present
+
+    @classmethod
+    def from_columns(cls, days, columns, dictionaries, names):
+        if len(days) == 0:
+            return cls(np.zeros((0, 2), dtype=np.int64), np.zeros((0, 2), dtype=days.dtype), {
+                name: np.zeros((0, len(dictionaries[name]) + 1), dtype=bool) for name in names
+            })
+
+        periods = days.astype('datetime64[D]').astype(f'datetime64[{config.PARTITION_PERIOD}]')
+        starts = np.flatnonzero(np.concatenate([[True], periods[1:] != periods[:-1]]))
+        stops = np.append(starts[1:], len(days))
+        partition = np.repeat(np.arange(len(starts)), stops - starts)
+
+        present = {}
+        for name in names:
+            present[name] = np.zeros((len(starts), len(dictionaries[name]) + 1), dtype=bool)
+            present[name][partition, columns[name]] = True
+
+        return cls(np.stack([starts, stops], axis=1), np.stack([days[starts], days[stops - 1]], axis=1), present)
+
+    @classmethod
+    def load(cls, path, names):
+        '''partitions saved next to the arrays of a store or a cube, None for directories saved without them.
+        '''
+        if not os.path.exists(os.path.join(path, 'partitions.bounds.npy')):
+            return None
+
+        arrays = _load_arrays(path, ['partitions.bounds', 'partitions.days'] + [f'partitions.{name}' for name in names],
+                              None)
+        return cls(arrays['partitions.bounds'], arrays['partitions.days'],
+                   {name: arrays[f'partitions.{name}'] for name in names})
+
+    def save(self, path):
+        _save_arrays(path, {'partitions.bounds': self.bounds, 'partitions.days': self.days})
+        _save_arrays(path, {f'partitions.{name}': present for name, present in self.present.items()})
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def select(self, start, stop, start_day, end_day, codes):
+        '''(start, stop) row ranges within rows start to stop of the partitions that may match, codes holding the
+        selected codes of each dimension.
+        '''
+        keep = (self.days[:, 1] >= start_day) & (self.days[:, 0] <= end_day)
+        for name, selected in codes.items():
+            keep &= self.present[name][:, selected].any(axis=1)
+
+        return np.clip(self.bounds[keep], start, stop)
+
+
+class OrderStore:
+    '''columnar, dictionary-encoded copy of the consolidated orders used by the application.
+
+    Categorical columns are kept as integer codes into a dictionary of their values (-1 for missing), dates
+    as int64 days since epoch and measures as fixed width floats. Rows are sorted by purchase date so that a date
+    range is a contiguous slice found by binary search. Filters work on the codes only and rows are decoded back to a
+    DataFrame for the selected subset.
+
+    A store saves to a directory of .npy files, one per column and per index, plus its dictionaries. Loading
+    memory-maps the arrays so that every process serving the same files shares their pages. The version is a digest
+    of the content, results derived from the store can be cached under it.
+
+    Stores are never modified in place: appending a batch of orders returns a new store whose dictionaries extend
+    the current ones, so that the codes of known values, and everything derived from them, stay valid.
+    '''
+
+    def __init__(self, columns, dictionaries, indexes=None, version=None, partitions=None):
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self.indexes = indexes or {
+            name: BitmapIndex.from_codes(columns[name], len(dictionaries[name])) for name in config.STORE_INDEXED
+        }
+        self.partitions = partitions or Partitions.from_columns(
+            columns['order_purchase_timestamp'], columns, dictionaries, config.STORE_INDEXED)
+        self.version = version or _digest(columns, dictionaries)
+        self._lookups = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        columns, dictionaries = {}, {}
+        df = df.sort_values('order_purchase_timestamp', kind='mergesort')
+
+        for name in config.STORE_CATEGORICAL:
+            codes, uniques = pd.factorize(df[name], sort=True)
+            columns[name] = codes.astype(_code_dtype(len(uniques)))
+            dictionaries[name] = np.asarray(uniques, dtype=object)
+
+        for name in config.STORE_DATE:
+            columns[name] = to_epoch_day(df[name])
+
+        for name, dtype in config.STORE_NUMERIC.items():
+            columns[name] = df[name].to_numpy(dtype=dtype)
+
+        return cls(columns, dictionaries)
+
+    def append(self, df, removed_orders=()):
+        '''new store holding the rows of this one, except those of the removed orders, followed by the rows of df.
+        '''
+        columns, dictionaries = {}, {}
+        df = df.sort_values('order_purchase_timestamp', kind='mergesort')
+
+        for name in config.STORE_CATEGORICAL:
+            values = df[name].to_numpy(dtype=object)
+            known = self._lookup(name).get_indexer(values)
+            added = pd.unique(values[(known < 0) & pd.notna(values)])
+            dictionaries[name] = np.concatenate([self.dictionaries[name], np.asarray(added, dtype=object)])
+
+            dtype = _code_dtype(len(dictionaries[name]))
+            codes = pd.Index(dictionaries[name]).get_indexer(values) if len(added) else known
+            columns[name] = np.concatenate([self.columns[name].astype(dtype), codes.astype(dtype)])
+
+        for name in config.STORE_DATE:
+            columns[name] = np.concatenate([self.columns[name], to_epoch_day(df[name])])
+
+        for name, dtype in config.STORE_NUMERIC.items():
+            columns[name] = np.concatenate([self.columns[name], df[name].to_numpy(dtype=dtype)])
+
+        # the version chains the current one with a digest of the change
+        delta = _digest({name: values[len(self):] for name, values in columns.items()}, dictionaries)
+        delta += '|'.join(sorted(map(str, removed_orders)))
+        version = hashlib.sha1(f'{self.version}{delta}'.encode()).hexdigest()
+
+        kept = ~self.isin('order_id', removed_orders) if len(removed_orders) else None
+        days = columns['order_purchase_timestamp']
+        in_order = not len(self) or not len(df) or days[len(self)] >= days[len(self) - 1]
+
+        indexes = None
+        if kept is None and in_order:
+            # pure append at the end of the date range, the bitmaps only need to be extended
+            indexes = {
+                name: index.append(columns[name][len(self):], len(dictionaries[name]))
+                for name, index in self.indexes.items()
+            }
+        else:
+            rows = np.arange(len(days)) if kept is None else np.concatenate([
+                np.flatnonzero(kept), np.arange(len(self), len(days))
+            ])
+            rows = rows[np.argsort(days[rows], kind='mergesort')]
+            columns = {name: values[rows] for name, values in columns.items()}
+
+        return OrderStore(columns, dictionaries, indexes, version)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'store.json')) as f:
+            meta = json.load(f)
+        dictionaries = {name: np.asarray(values, dtype=object) for name, values in meta['dictionaries'].items()}
+
+        columns = _load_arrays(path, config.STORE_COLUMNS, mmap_mode)
+        bitmaps = _load_arrays(path, [f'{name}.bitmaps' for name in config.STORE_INDEXED], mmap_mode)
+        indexes = {
+            name: BitmapIndex(bitmaps[f'{name}.bitmaps'], len(columns[name])) for name in config.STORE_INDEXED
+        }
+
+        return cls(columns, dictionaries, indexes, meta['version'], Partitions.load(path, config.STORE_INDEXED))
+
+    def save(self, path):
+        tmp = _temporary_directory(path)
+        _save_arrays(tmp, self.columns)
+        _save_arrays(tmp, {f'{name}.bitmaps': index.bitmaps for name, index in self.indexes.items()})
+        self.partitions.save(tmp)
+
+        with open(os.path.join(tmp, 'store.json'), 'w') as f:
+            json.dump({
+                'version': self.version,
+                'dictionaries': {name: list(values) for name, values in self.dictionaries.items()},
+            }, f)
+
+        _replace_directory(tmp, path)
+
+    def __len__(self):
+        return len(self.columns[config.STORE_DATE[0]])
+
+    def memory_usage(self):
+        return sum(c.nbytes for c in self.columns.values())
+
+    def values(self, name):
+        return sorted(self.dictionaries[name])
+
+    def min_date(self):
+        return _epoch_day_to_date(self.columns['order_purchase_timestamp'].min())
+
+    def max_date(self):
+        return _epoch_day_to_date(self.columns['order_purchase_timestamp'].max())
+
+    def codes(self, name, values):
+        '''codes of the given values, values absent from the dictionary are ignored.
+        '''
+        codes = self._lookup(name).get_indexer(np.asarray(list(values), dtype=object))
+
+        return codes[codes >= 0]
+
+    def _lookup(self, name):
+        if name not in self._lookups:
+            self._lookups[name] = pd.Index(self.dictionaries[name])
+
+        return self._lookups[name]
+
+    def isin(self, name, values):
+        if name in self.indexes:
+            bitmap = self.indexes[name].select(self.codes(name, values))
+            if bitmap is None:
+                return np.ones(len(self), dtype=bool)
+
+            return unpack_bitmap(bitmap, 0, len(self))
+
+        # one extra slot in the lookup table so that missing values (code -1) never match
+        lookup = np.zeros(len(self.dictionaries[name]) + 1, dtype=bool)
+        lookup[self.codes(name, values)] = True
+
+        return lookup[self.columns[name]]
+
+    def date_range(self, start_date, end_date):
+        '''first and past-the-end rows purchased between the two dates, both included.
+        '''
+        days = self.columns['order_purchase_timestamp']
+        start = days.searchsorted(to_epoch_day(start_date), side='left')
+        stop = days.searchsorted(to_epoch_day(end_date), side='right')
+
+        return int(start), int(stop)
+
+    @metrics.timed('filter')
+    def rows(self, start_date, end_date, payment_type, product_category, customer_state):
+        '''rows matching the filters, as a slice when only the dates restrict the selection, otherwise as indices.
+        '''
+        start, stop = self.date_range(start_date, end_date)
+
+        codes = {}
+        for name, values in (
+                ('payment_type', payment_type),
+                ('product_category_name', product_category),
+                ('state_name', customer_state),
+        ):
+            codes[name] = self.codes(name, values)
+            if not self.indexes[name].restricts(codes[name]):
+                del codes[name]
+
+        if not codes:
+            return slice(start, stop)
+
+        # skip the partitions without any selected value, AND the packed bitmaps of the restricted dimensions over
+        # each remaining partition only and unpack once
+        rows = [np.zeros(0, dtype=np.int64)]
+        for first, last in self.partitions.select(start, stop, to_epoch_day(start_date), to_epoch_day(end_date), codes):
+            if first < last:
+                jobs.checkpoint()
+                metrics.scanned(last - first)
+                bitmap = np.bitwise_and.reduce([self.indexes[name].select(codes[name], first, last) for name in codes])
+                rows.append(first + np.flatnonzero(unpack_bitmap(bitmap, first, last)))
+
+        return np.concatenate(rows)
+
+    def filter(self, start_date, end_date, payment_type, product_category, customer_state):
+        return self.take(self.rows(start_date, end_date, payment_type, product_category, customer_state))
+
+    @metrics.timed('decode')
+    def take(self, rows=slice(None)):
+        '''decode the selected rows (boolean mask, indices or slice) to a DataFrame with categorical columns.
+        '''
+        df = pd.DataFrame()
+
+        for name in config.STORE_CATEGORICAL:
+            df[name] = pd.Categorical.from_codes(self.columns[name][rows], categories=self.dictionaries[name])
+
+        for name in config.STORE_DATE:
+            df[name] = self.columns[name][rows].astype('datetime64[D]').astype('datetime64[ns]')
+
+        for name in config.STORE_NUMERIC:
+            df[name] = self.columns[name][rows]
+
+        return df
+
+    @metrics.timed('aggregate', rows=1)
+    def seller_sales(self, rows, n_top=10):
+        '''revenue of the top sellers of the completed orders, and distinct sellers and mean payment of the completed
+        orders per month of the year.
+        '''
+        if isinstance(rows, slice):
+            rows = slice(*rows.indices(len(self)))
+
+        completed = np.zeros(len(self.dictionaries['order_status']) + 1, dtype=bool)
+        completed[self.codes('order_status', config.ORDER_STATUS_CONSO)] = True
+        n_sellers = len(self.dictionaries['seller_id'])
+        p = sketch.precision(config.HLL_ERROR) if config.DISTINCT_COUNT == 'hll' else None
+
+        def partial(rows):
+            # per seller: rows and revenue, per month: rows, payments and their sum, sellers present
+            selected = completed[self.columns['order_status'][rows]]
+            seller = self.columns['seller_id'][rows][selected].astype(np.int64)
+            payment = self.columns['payment_value'][rows][selected]
+            days = self.columns['order_purchase_timestamp'][rows][selected]
+            month = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64) % 12
+            paid, known = ~np.isnan(payment), seller >= 0
+
+            if p is None:
+                sellers = np.unique(month[known] * n_sellers + seller[known])
+            else:
+                register, rank = sketch.registers(sketch.hash_values(seller[known]), p)
+                sellers = sketch.merge(register, rank, p, month[known], 12)
+
+            return (
+                np.bincount(seller[known], minlength=n_sellers),
+                np.bincount(seller[known], weights=np.where(paid, payment, 0.)[known], minlength=n_sellers),
+                np.bincount(month, minlength=12),
+                np.bincount(month[paid], minlength=12),
+                np.bincount(month[paid], weights=payment[paid], minlength=12),
+                sellers,
+            )
+
+        def merge(partials):
+            partials = list(zip(*partials))
+            return [parallel.add(values) for values in partials[:-1]] + [
+                (parallel.union if p is None else parallel.maximum)(partials[-1])
+            ]
+
+        seller_rows, revenue, month_rows, month_paid, month_payment, sellers = parallel.map_reduce(
+            partial, merge, rows)
+
+        present = np.flatnonzero(seller_rows)
+        top = present[np.argsort(-revenue[present], kind='mergesort')[:n_top]]
+        df_rank = pd.DataFrame({'seller_id': self.dictionaries['seller_id'][top], 'payment_value': revenue[top]})
+
+        if p is None:
+            n_seller = np.bincount(sellers // n_sellers, minlength=12)
+        else:
+            n_seller = np.rint(sketch.estimate(sellers)).astype(np.int64)
+
+        months = np.flatnonzero(month_rows)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_payment = month_payment[months] / month_paid[months]
+
+        df_month = pd.DataFrame({
+            'month_no': months + 1,
+            'month_name': pd.DatetimeIndex((np.datetime64('2000-01') + months).astype('datetime64[ns]')).month_name(),
+            'seller_id': n_seller[months],
+            'payment_value': mean_payment,
+        })
+
+        return df_rank, df_month
+
+
+class OrderCube:
+    '''daily cube of the orders built by build_cube.
+
+    Selections return the indices of the matching cells and every aggregate can be grouped by passing one group id
+    per selected cell. Distinct counts are exact unless the cube holds sketches of the given precision. The version
+    is the one of the store the cube was built from.
+    '''
+
+    def __init__(self, dimensions, measures, distinct, dictionaries, states, precision=None, version=None,
+                 partitions=None):
+        self.dimensions = dimensions
+        self.measures = measures
+        self.distinct = distinct
+        self.dictionaries = dictionaries
+        self.states = states
+        self.precision = precision
+        self.version = version
+        self.partitions = partitions or Partitions.from_columns(
+            dimensions['order_purchase_timestamp'], dimensions, dictionaries, config.CUBE_DIMENSIONS)
+
+    def __len__(self):
+        return len(self.measures['n_rows'])
+
+    def update(self, store, days):
+        '''cube of an updated store: the cells of the given days are rebuilt from the store, the others are kept.
+        '''
+        store_days = store.columns['order_purchase_timestamp']
+        starts, stops = store_days.searchsorted(days, side='left'), store_days.searchsorted(days, side='right')
+        rows = _expand(starts, stops - starts)
+        dimensions, measures, distinct = _aggregate(store, rows, self.precision)
+
+        # kept cells followed by the rebuilt ones, reordered by day
+        keep = ~np.isin(self.dimensions['order_purchase_timestamp'], days)
+        order = np.argsort(np.concatenate([
+            self.dimensions['order_purchase_timestamp'][keep], dimensions['order_purchase_timestamp']
+        ]), kind='mergesort')
+
+        for name, values in dimensions.items():
+            dimensions[name] = np.concatenate([self.dimensions[name][keep], values])[order]
+        for name, values in measures.items():
+            measures[name] = np.concatenate([self.measures[name][keep], values])[order]
+        for name, (offsets, members) in distinct.items():
+            old_offsets, old_members = self.distinct[name]
+            starts = np.concatenate([old_offsets[:-1][keep], offsets[:-1] + len(old_members)])[order]
+            lengths = np.concatenate([np.diff(old_offsets)[keep], np.diff(offsets)])[order]
+            distinct[name] = _offsets(lengths), _gather(np.concatenate([old_members, members]), starts, lengths)
+
+        return OrderCube(dimensions, measures, distinct, store.dictionaries, _state_attributes(store), self.precision,
+                         store.version)
+
+    @classmethod
+    def load(cls, path, dictionaries, mmap_mode='r'):
+        '''memory-map a cube saved by save, dictionaries are the ones of the store it was built from.
+        '''
+        with open(os.path.join(path, 'cube.json')) as f:
+            meta = json.load(f)
+
+        dimensions = _load_arrays(path, ['order_purchase_timestamp'] + config.CUBE_DIMENSIONS, mmap_mode)
+        measures = _load_arrays(path, ['n_rows'] + config.CUBE_SUM, mmap_mode)
+        arrays = _load_arrays(
+            path, [f'{name}.{part}' for name in config.CUBE_DISTINCT for part in ('offsets', 'members')], mmap_mode)
+        distinct = {name: (arrays[f'{name}.offsets'], arrays[f'{name}.members']) for name in config.CUBE_DISTINCT}
+        states = pd.DataFrame(meta['states']['data'], index=meta['states']['index'],
+                              columns=meta['states']['columns'])
+
+        return cls(dimensions, measures, distinct, dictionaries, states, meta['precision'], meta.get('version'),
+                   Partitions.load(path, config.CUBE_DIMENSIONS))
+
+    def save(self, path):
+        tmp = _temporary_directory(path)
+        _save_arrays(tmp, self.dimensions)
+        _save_arrays(tmp, self.measures)
+        for name, (offsets, members) in self.distinct.items():
+            _save_arrays(tmp, {f'{name}.offsets': offsets, f'{name}.members': members})
+        self.partitions.save(tmp)
+
+        with open(os.path.join(tmp, 'cube.json'), 'w') as f:
+            json.dump({
+                'precision': self.precision,
+                'version': self.version,
+                'states': json.loads(self.states.to_json(orient='split')),
+            }, f)
+
+        _replace_directory(tmp, path)
+
+    @metrics.timed('filter')
+    def cells(self, start_date, end_date, payment_type, product_category, customer_state):
+        start_day, end_day = to_epoch_day(start_date), to_epoch_day(end_date)
+        days = self.dimensions['order_purchase_timestamp']
+        start, stop = days.searchsorted(start_day, side='left'), days.searchsorted(end_day, side='right')
+
+        filters = (
+            ('payment_type', payment_type),
+            ('product_category_name', product_category),
+            ('state_name', customer_state),
+        )
+
+        # cells of the partitions holding selected values of every dimension
+        codes = {name: np.flatnonzero(np.isin(self.dictionaries[name], list(values))) for name, values in filters}
+        ranges = self.partitions.select(start, stop, start_day, end_day, codes)
+        cells = _expand(ranges[:, 0], ranges[:, 1] - ranges[:, 0])
+        metrics.scanned(len(cells))
+
+        for name, values in filters:
+            cells = self.restrict(cells, name, values)
+
+        return cells
+
+    def restrict(self, cells, name, values):
+        '''cells among the given ones whose dimension takes one of the values.
+        '''
+        dictionary = self.dictionaries[name]
+        lookup = np.zeros(len(dictionary) + 1, dtype=bool)
+        lookup[:-1] = np.isin(dictionary, list(values))
+
+        return cells[lookup[self.dimensions[name][cells]]]
+
+    def sum(self, name, cells, by=None, n_groups=None):
+        def partial(cells, by):
+            values = self.measures[name][cells]
+            return values.sum() if by is None else np.bincount(by, weights=values, minlength=n_groups)
+
+        return parallel.map_reduce(partial, parallel.add, cells, by)
+
+    def count_distinct(self, name, cells, by=None, n_groups=None):
+        # partitions of the cells merge their sketches (sparse per group), their masks of the members present or,
+        # per group, their sorted (group, member) pairs
+        offsets, members = self.distinct[name]
+        n_values = len(self.dictionaries[name])
+
+        def partial(cells, by):
+            lengths = offsets[cells + 1] - offsets[cells]
+            values = _gather(members, offsets[cells], lengths).astype(np.int64)
+            by = None if by is None else np.repeat(by, lengths)
+
+            if self.precision is not None and by is None:
+                return sketch.merge(values >> 6, (values & 63).astype(np.uint8), self.precision)
+            if self.precision is not None:
+                return sketch.sparse(values >> 6, values & 63, self.precision, by)
+            if by is None:
+                return np.bincount(values, minlength=n_values) > 0
+
+            return np.unique(by.astype(np.int64) * n_values + values)
+
+        if self.precision is not None and by is None:
+            return int(np.rint(sketch.estimate(parallel.map_reduce(partial, parallel.maximum, cells, by))[0]))
+        if self.precision is not None:
+            entries = parallel.map_reduce(partial, sketch.sparse_merge, cells, by)
+            return np.rint(sketch.estimate_sparse(entries, self.precision, n_groups)).astype(np.int64)
+
+        if by is None:
+            return np.count_nonzero(parallel.map_reduce(partial, parallel.logical_or, cells, by))
+
+        pairs = parallel.map_reduce(partial, parallel.union, cells, by)
+        return np.bincount(pairs // n_values, minlength=n_groups)
+
+    # KPIs
+    def completed(self, cells):
+        return self.restrict(cells, 'order_status', config.ORDER_STATUS_CONSO)
+
+    def revenue(self, cells):
+        return self.sum('payment_value', self.completed(cells))
+
+    def aov(self, cells):
+        cells = self.completed(cells)
+        n_order = self.count_distinct('order_id', cells)
+
+        return 0. if n_order == 0 else self.sum('payment_value', cells) / n_order
+
+    def abandonment_rate(self, cells):
+        n_order = self.count_distinct('order_id', cells)
+        n_completed = self.count_distinct('order_id', self.completed(cells))
+
+        return 0. if n_order == 0 else 100. * (1. - n_completed / n_order)
+
+    @metrics.timed('aggregate', rows=1)
+    def prefix_sums(self, cells):
+        '''daily revenue and number of orders of the completed orders of the cells over every day of the cube.
+        '''
+        cells = self.completed(cells)
+        days = self.dimensions['order_purchase_timestamp']
+        first_day = days[0] if len(days) else 0
+        n_days = int(days[-1] - first_day) + 1 if len(days) else 0
+        day = days[cells] - first_day
+
+        return PrefixSums(first_day, {
+            'payment_value': self.sum('payment_value', cells, day, n_days),
+            'order_id': self.count_distinct('order_id', cells, day, n_days),
+        })
+
+    # charts
+    @metrics.timed('aggregate', rows=1)
+    def daily_sales(self, cells):
+        '''daily revenue and number of orders of the completed orders, every day of the selected span included.
+        '''
+        cells = self.completed(cells)
+        days = self.dimensions['order_purchase_timestamp'][cells]
+        if len(days) == 0:
+            return pd.DataFrame({'order_purchase_timestamp': pd.to_datetime([]), 'payment_value': [], 'order_id': []})
+
+        day = days - days.min()
+        n_days = int(day.max()) + 1
+
+        return pd.DataFrame({
+            'order_purchase_timestamp': np.arange(days.min(), days.min() + n_days).astype('datetime64[D]').astype(
+                'datetime64[ns]'),
+            'payment_value': self.sum('payment_value', cells, day, n_days),
+            'order_id': self.count_distinct('order_id', cells, day, n_days),
+        })
+
+    def daily_sales_by(self, cells, names):
+        '''daily revenue of the completed orders per combination of the given dimensions.
+
+        Returns the combinations as a DataFrame, the days spanned by the cube and a matrix with one row per
+        combination and one column per day.
+        '''
+        cells = self.completed(cells)
+        keys, series = np.unique(np.stack([self.dimensions[name][cells] for name in names]), axis=1,
+                                 return_inverse=True)
+        n_series = keys.shape[1]
+
+        days = self.dimensions['order_purchase_timestamp']
+        first_day, n_days = days[0], int(days[-1] - days[0]) + 1
+        day = self.dimensions['order_purchase_timestamp'][cells] - first_day
+
+        x = np.bincount(series.ravel() * n_days + day, weights=self.measures['payment_value'][cells],
+                        minlength=n_series * n_days).reshape(n_series, n_days)
+        df_series = pd.DataFrame({name: self.dictionaries[name][keys[i]] for i, name in enumerate(names)})
+
+        return df_series, np.arange(first_day, first_day + n_days).astype('datetime64[D]'), x
+
+    @metrics.timed('aggregate', rows=1)
+    def state_sales(self, cells):
+        '''revenue per state and per state and month (labelled by month end) of all orders.
+        '''
+        states = self.dimensions['state_name'][cells]
+        codes, state = np.unique(states, return_inverse=True)
+
+        df_map = self.states.loc[codes].reset_index(drop=True)
+        df_map['payment_value'] = self.sum('payment_value', cells, state, len(codes))
+
+        months = self.dimensions['order_purchase_timestamp'][cells].astype('datetime64[D]').astype('datetime64[M]')
+        keys, group = np.unique(np.stack([state, months.astype(np.int64)]), axis=1, return_inverse=True)
+
+        df_time = self.states.loc[codes[keys[0]], ['customer_state', 'state_name']].reset_index(drop=True)
+        df_time['order_purchase_timestamp'] = ((keys[1].astype('datetime64[M]') + 1).astype('datetime64[D]') - 1).astype(
+            'datetime64[ns]')
+        df_time['payment_value'] = self.sum('payment_value', cells, group.ravel(), len(keys[0]))
+
+        df_map = df_map.sort_values(['customer_state', 'state_name']).reset_index(drop=True)
+        df_time = df_time.sort_values(['customer_state', 'state_name', 'order_purchase_timestamp']).reset_index(drop=True)
+
+        return df_map, df_time
+
+    @metrics.timed('aggregate', rows=1)
+    def product_categories(self, cells):
+        '''revenue, mean order value and distinct customers, orders and sellers per category of the completed orders.
+        '''
+        cells = self.completed(cells)
+        codes, category = np.unique(self.dimensions['product_category_name'][cells], return_inverse=True)
+        n_categories = len(codes)
+        total_order_value = self.sum('payment_value', cells, category, n_categories)
+        n_order = self.count_distinct('order_id', cells, category, n_categories)
+
+        return pd.DataFrame({
+            'product_category_name': self.dictionaries['product_category_name'][codes],
+            'total_order_value': total_order_value,
+            'mean_order_value': total_order_value / n_order,
+            'n_customer': self.count_distinct('customer_id', cells, category, n_categories),
+            'n_order': n_order,
+            'n_seller': self.count_distinct('seller_id', cells, category, n_categories),
+        })
+
+
+class PrefixSums:
+    '''cumulative sums of daily series starting at first_day (epoch day), any window total is two lookups.
+
+    Built once per selection of dimensions, it answers every date range of that selection: totals, rolling means and
+    comparisons with a previous period.
+    '''
+
+    def __init__(self, first_day, series):
+        self.first_day = int(first_day)
+        self.n_days = len(next(iter(series.values())))
+        self.sums = {name: np.concatenate([[0.], np.cumsum(values)]) for name, values in series.items()}
+
+    def _index(self, day):
+        return int(np.clip(day - self.first_day, 0, self.n_days))
+
+    def total(self, name, start_day, end_day):
+        '''total of the series from start_day to end_day, both included, days out of the series count for 0 and so
+        does a range ending before it starts.
+        '''
+        if end_day < start_day:
+            return 0.
+
+        sums = self.sums[name]
+        return sums[self._index(end_day + 1)] - sums[self._index(start_day)]
+
+    def change(self, name, start_day, end_day, offset=None):
+        '''relative change in percent of the total over the days against the same days offset days earlier (the
+        previous period of the same length by default), nan when the earlier total is 0 or the range is empty.
+        '''
+        if end_day < start_day:
+            return np.nan
+
+        offset = end_day - start_day + 1 if offset is None else offset
+        previous = self.total(name, start_day - offset, end_day - offset)
+
+        return np.nan if previous == 0 else 100. * (self.total(name, start_day, end_day) / previous - 1.)
+
+    def rolling_mean(self, name, window, start_day, end_day):
+        '''mean over the window days ending on each day from start_day + window - 1 to end_day.
+        '''
+        sums = self.sums[name]
+        stops = np.arange(self._index(start_day + window), self._index(end_day + 1) + 1)
+        days = self.first_day + stops - 1
+
+        return pd.DataFrame({
+            'order_purchase_timestamp': days.astype('datetime64[D]').astype('datetime64[ns]'),
+            name: (sums[stops] - sums[stops - window]) / window,
+        })
+
+
+def _digest(columns, dictionaries):
+    digest = hashlib.sha1()
+    for name in sorted(columns):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(columns[name]).tobytes())
+    digest.update(json.dumps({name: list(values) for name, values in sorted(dictionaries.items())}).encode())
+
+    return digest.hexdigest()
+
+
+def _temporary_directory(path):
+    tmp = f'{path}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    return tmp
+
+
+def _replace_directory(tmp, path):
+    # swap directories instead of overwriting the files, processes may still have the previous ones memory-mapped
+    old = f'{path}.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _save_arrays(path, arrays):
+    for name, values in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), values)
+
+
+def _load_arrays(path, names, mmap_mode):
+    return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in names}
+
+
+def _epoch_day_to_date(day):
+    return pd.Timestamp(np.datetime64(int(day), 'D')).date()
+
+
 # controls
 def min_date(df):
     return df['order_purchase_timestamp'].min().date()
@@ -99,6 +1253,21 @@ def states(df):
 
 
 # KPIS
+def nunique(values):
+    '''number of distinct values of a Series, estimated with a HyperLogLog sketch when config.DISTINCT_COUNT is 'hll'.
+    '''
+    if config.DISTINCT_COUNT != 'hll':
+        return values.nunique()
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.codes
+        values = values[values >= 0]
+    else:
+        values = values.dropna()
+
+    return sketch.count_distinct(values.to_numpy(), sketch.precision(config.HLL_ERROR))
+
+
 def revenue(df):
     df = df[df['order_status'].isin(config.ORDER_STATUS_CONSO)]
     return df['payment_value'].sum()
@@ -107,7 +1276,7 @@ def revenue(df):
 def aov(df):
     df = df[df['order_status'].isin(config.ORDER_STATUS_CONSO)]
     revenue = df['payment_value'].sum()
-    n_order = df['order_id'].nunique()
+    n_order = nunique(df['order_id'])
 
     if n_order == 0:
         aov = 0.
@@ -118,8 +1287,8 @@ def aov(df):
 
 
 def abandonment_rate(df):
-    n_completed = df.loc[df['order_status'].isin(config.ORDER_STATUS_CONSO), 'order_id'].nunique()
-    n_order = df['order_id'].nunique()
+    n_completed = nunique(df.loc[df['order_status'].isin(config.ORDER_STATUS_CONSO), 'order_id'])
+    n_order = nunique(df['order_id'])
 
     if n_order == 0:
         abandonment_rate = 0.
@@ -131,8 +1300,8 @@ def abandonment_rate(df):
 
 def order_satisfaction(df):
     df = df[~df['review_score'].isna()]
-    n_statisfied = df.loc[df['review_score'] >= 4, 'order_id'].nunique()
-    n_review = df['order_id'].nunique()
+    n_statisfied = nunique(df.loc[df['review_score'] >= 4, 'order_id'])
+    n_review = nunique(df['order_id'])
 
     if n_review == 0:
         order_statisfaction = 0.
@@ -140,3 +1309,16 @@ def order_satisfaction(df):
         order_statisfaction = 100 * n_statisfied / n_review
 
     return order_statisfaction
+
+
+if __name__ == '__main__':
+    # consolidate the raw tables: python -m src.data [--start-date 2018-01-01] [--end-date 2018-08-09]
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start-date', default=config.CONSOLIDATE_START_DATE)
+    parser.add_argument('--end-date', default=config.CONSOLIDATE_END_DATE)
+    parser.add_argument('--chunk-size', type=int, default=config.CONSOLIDATE_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    consolidate_dataset(args.start_date, args.end_date, args.chunk_size)
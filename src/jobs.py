@@ -0,0 +1,102 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config, metrics
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    '''raised at the checkpoints of a job no session waits for anymore.
+    '''
+
+
+def checkpoint():
+    '''stop the current job when it has been cancelled, a no-op outside of jobs.
+    '''
+    event = getattr(_local, 'cancelled', None)
+    if event is not None and event.is_set():
+        raise Cancelled()
+
+
+class Job:
+    def __init__(self, future, cancelled):
+        self.future = future
+        self.cancelled = cancelled
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+
+class JobService:
+    '''runs functions in a thread pool on behalf of sessions, each session waiting for one job at most per slot.
+
+    Sessions requesting the same key share its job. A session drops its claim on a job when it requests another key
+    in the same slot, gets the result, or stops polling for ttl seconds. Jobs left without claims are cancelled:
+    removed from the queue when pending, stopped at their next checkpoint when running.
+    '''
+
+    def __init__(self, max_workers=None, ttl=None):
+        self.ttl = ttl or config.JOB_TTL
+        self._executor = ThreadPoolExecutor(max_workers or config.JOB_WORKERS)
+        self._jobs = {}
+        self._claims = {}
+        self._lock = threading.Lock()
+
+    def get(self, session, slot, key, function):
+        '''(done, result) of the job of key waited for by the slot of a session, function is submitted on the first
+        request of key. Never blocks.
+        '''
+        now = time.time()
+        claim = (session, slot)
+        with self._lock:
+            self._expire(now)
+            previous = self._claims.get(claim)
+            self._claims[claim] = (key, now)
+            if previous is not None and previous[0] != key:
+                self._drop(previous[0], slot)
+
+            job = self._jobs.get(key)
+            if job is None:
+                cancelled = threading.Event()
+                job = self._jobs[key] = Job(self._executor.submit(_run, function, cancelled), cancelled)
+                metrics.job(slot, 'submitted')
+
+        if not job.future.done():
+            return False, None
+
+        self.release(session, slot)
+        return True, job.future.result()
+
+    def release(self, session, slot):
+        '''drop the claim of the slot of a session, a result found elsewhere makes its job useless.
+        '''
+        with self._lock:
+            claim = self._claims.pop((session, slot), None)
+            if claim is not None:
+                self._drop(claim[0], slot)
+
+    def _drop(self, key, slot):
+        if any(claimed == key for claimed, _ in self._claims.values()):
+            return
+
+        job = self._jobs.pop(key, None)
+        if job is not None and not job.future.done():
+            job.cancel()
+            metrics.job(slot, 'cancelled')
+
+    def _expire(self, now):
+        for claim, (key, polled) in list(self._claims.items()):
+            if now - polled > self.ttl:
+                del self._claims[claim]
+                self._drop(key, claim[1])
+
+
+def _run(function, cancelled):
+    _local.cancelled = cancelled
+    try:
+        return function()
+    finally:
+        _local.cancelled = None
@@ -0,0 +1,182 @@
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from . import config, metrics, parallel, sketch
+
+Kpi = namedtuple('Kpi', ['name', 'label', 'format', 'compute', 'period'])
+
+# Masks split the selected orders into groups, KPIs are declared as functions of the sums and distinct orders of
+# these groups. A mask takes the store and the selected rows and must give the same value for every row of an order
+# (status, review...) so that each order falls in exactly one group.
+MASKS = OrderedDict()
+
+# KPIs in display order
+KPIS = OrderedDict()
+
+
+def mask(name):
+    '''declare a mask of the selected rows.
+    '''
+    def decorator(function):
+        MASKS[name] = function
+        return function
+
+    return decorator
+
+
+def kpi(name, label, format, period=False):
+    '''declare a KPI computed from Totals, shown with its label and format string.
+
+    Period KPIs are computed instead from the data.PrefixSums of the selected dimensions and the first and last
+    selected days.
+    '''
+    def decorator(function):
+        KPIS[name] = Kpi(name, label, format, function, period)
+        return function
+
+    return decorator
+
+
+class Totals:
+    '''sums of the measures and distinct orders of the selected rows of a store, per combination of the masks.
+
+    Rows are scanned once to assign their group, then every sum is one bincount and the distinct orders of all the
+    groups are counted at once, exactly or with HyperLogLog sketches when config.DISTINCT_COUNT is 'hll'. Each step
+    runs on partitions of the rows in parallel (see parallel.map_reduce).
+    '''
+
+    def __init__(self, store, rows):
+        if isinstance(rows, slice):
+            rows = slice(*rows.indices(len(store)))
+
+        self.store = store
+        self.rows = rows
+        self.n_groups = 2 ** len(MASKS)
+        self._bits = {name: bit for bit, name in enumerate(MASKS)}
+        self.group = parallel.map_reduce(self._group, parallel.concatenate, rows)
+
+        if config.DISTINCT_COUNT == 'hll':
+            p = sketch.precision(config.HLL_ERROR)
+
+            def partial(rows, group):
+                register, rank = sketch.registers(sketch.hash_values(store.columns['order_id'][rows]), p)
+                return sketch.merge(register, rank, p, group, self.n_groups)
+
+            self._sketches = parallel.map_reduce(partial, parallel.maximum, rows, self.group)
+        else:
+            n_values = len(store.dictionaries['order_id'])
+
+            def partial(rows, group):
+                return np.unique(group * n_values + store.columns['order_id'][rows].astype(np.int64))
+
+            keys = parallel.map_reduce(partial, parallel.union, rows, self.group)
+            self._counts = np.bincount(keys // n_values, minlength=self.n_groups)
+
+        self._sums = {}
+
+    def _group(self, rows):
+        group = np.zeros(metrics.size(rows), dtype=np.int64)
+        for bit, function in enumerate(MASKS.values()):
+            group |= function(self.store, rows).astype(np.int64) << bit
+
+        return group
+
+    def groups(self, mask=None):
+        '''groups of the rows within the mask, every group when mask is None.
+        '''
+        groups = np.arange(self.n_groups)
+        if mask is None:
+            return groups
+
+        return groups[(groups >> self._bits[mask]) & 1 == 1]
+
+    def sum(self, measure, mask=None):
+        if measure not in self._sums:
+            def partial(rows, group):
+                return np.bincount(group, weights=self.store.columns[measure][rows], minlength=self.n_groups)
+
+            self._sums[measure] = parallel.map_reduce(partial, parallel.add, self.rows, self.group)
+
+        return self._sums[measure][self.groups(mask)].sum()
+
+    def orders(self, mask=None):
+        '''number of distinct orders within the mask.
+        '''
+        if config.DISTINCT_COUNT == 'hll':
+            return int(np.rint(sketch.estimate(self._sketches[self.groups(mask)].max(axis=0))[0]))
+
+        return int(self._counts[self.groups(mask)].sum())
+
+
+@metrics.timed('aggregate', rows=1)
+def compute(store, rows, prefix_sums=None, start_day=None, end_day=None):
+    '''value of every registered KPI over the given rows of the store, period KPIs need the prefix sums of the
+    selected dimensions and the selected days and are NaN (shown as n/a) without them.
+    '''
+    totals = Totals(store, rows)
+    period = prefix_sums is not None and start_day is not None and end_day is not None
+
+    values = OrderedDict()
+    for name, indicator in KPIS.items():
+        if indicator.period:
+            values[name] = indicator.compute(prefix_sums, start_day, end_day) if period else np.nan
+        else:
+            values[name] = indicator.compute(totals)
+
+    return values
+
+
+def format_values(values):
+    return ['n/a' if np.isnan(value) else KPIS[name].format.format(value) for name, value in values.items()]
+
+
+@mask('completed')
+def _completed(store, rows):
+    lookup = np.zeros(len(store.dictionaries['order_status']) + 1, dtype=bool)
+    lookup[store.codes('order_status', config.ORDER_STATUS_CONSO)] = True
+
+    return lookup[store.columns['order_status'][rows]]
+
+
+@mask('reviewed')
+def _reviewed(store, rows):
+    return ~np.isnan(store.columns['review_score'][rows])
+
+
+@mask('satisfied')
+def _satisfied(store, rows):
+    return store.columns['review_score'][rows] >= 4
+
+
+@kpi('revenue', 'Revenue', 'R$ {:,.0f}')
+def revenue(totals):
+    return totals.sum('payment_value', 'completed')
+
+
+@kpi('aov', 'Average order value', 'R$ {:.0f}')
+def aov(totals):
+    n_order = totals.orders('completed')
+    return 0. if n_order == 0 else totals.sum('payment_value', 'completed') / n_order
+
+
+@kpi('abandonment_rate', 'Abandonment rate', '{:.2f}%')
+def abandonment_rate(totals):
+    n_order = totals.orders()
+    return 0. if n_order == 0 else 100. * (1. - totals.orders('completed') / n_order)
+
+
+@kpi('order_satisfaction', 'Orders satisfaction', '{:.0f}%')
+def order_satisfaction(totals):
+    n_review = totals.orders('reviewed')
+    return 0. if n_review == 0 else 100. * totals.orders('satisfied') / n_review
+
+
+@kpi('revenue_change', 'Revenue vs previous period', '{:+.1f}%', period=True)
+def revenue_change(prefix_sums, start_day, end_day):
+    return prefix_sums.change('payment_value', start_day, end_day)
+
+
+@kpi('orders_change', 'Orders vs previous period', '{:+.1f}%', period=True)
+def orders_change(prefix_sums, start_day, end_day):
+    return prefix_sums.change('order_id', start_day, end_day)
@@ -0,0 +1,156 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+import pandas as pd
+
+from . import config, data, model
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+    '''one immutable version of the data served by the application: the store, its cube and its batch forecasts.
+
+    Snapshots compare and hash by version so that results computed from one can be cached under it.
+    '''
+
+    def __init__(self, store, cube, batch_forecasts=None):
+        self.store = store
+        self.cube = cube
+        self.batch_forecasts = batch_forecasts
+        self.version = store.version
+
+    @classmethod
+    def load(cls):
+        store = data.load_store()
+        return cls(store, data.load_cube(store), model.load_batch_forecast(store))
+
+    def __eq__(self, other):
+        return isinstance(other, Snapshot) and self.version == other.version
+
+    def __hash__(self):
+        return hash(self.version)
+
+
+class LiveDataset:
+    '''current snapshot of the data, replaced in the background when a new version is published.
+
+    A thread checks every interval seconds for order batches queued in config.DIR_INGEST, ingests them into the
+    saved dataset and loads any version published by save_dataset, here or by another process. The new snapshot is
+    loaded and warmed up off the request path then swapped in with a single assignment: requests read the snapshot
+    once and finish on the version they started with. The snapshot loaded first is warmed up by the thread once
+    started, requests arriving before are served without waiting.
+    '''
+
+    def __init__(self, interval=None, warm=None):
+        self.interval = interval or config.RELOAD_INTERVAL
+        self.warm = warm
+        self.snapshot = Snapshot.load()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='live-dataset', daemon=True)
+            self._thread.start()
+
+        return self
+
+    def _run(self):
+        # the first snapshot is warmed up here as well, off the import of the application
+        if self.warm is not None:
+            try:
+                self.warm(self.snapshot)
+            except Exception:
+                logger.exception('warming up the dataset failed')
+
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('refreshing the dataset failed')
+
+    def refresh(self):
+        '''ingest the queued batches and swap in the last published version, True when the snapshot changed.
+        '''
+        ingest_queue()
+
+        version = data.saved_version()
+        if version is None or version == self.snapshot.version:
+            return False
+
+        snapshot = Snapshot.load()
+        # the store may have been replaced again while loading, wait for a consistent pair
+        if snapshot.version != version or snapshot.cube.version != version:
+            return False
+
+        if self.warm is not None:
+            self.warm(snapshot)
+        self.snapshot = snapshot
+
+        return True
+
+
+def ingest_queue():
+    '''ingest the order batches queued in config.DIR_INGEST, in name order, and publish the new dataset.
+
+    A batch is a directory holding the raw Olist files (config.DATA_FILES) of the order, order_item,
+    order_payment and order_review tables and optionally customer. Ingested batches are moved to done/ and batches
+    that fail to ingest to failed/. One process at a time drains the queue, the others skip it.
+    '''
+    batches = sorted(
+        entry.path for entry in os.scandir(config.DIR_INGEST) if entry.is_dir() and entry.name not in ('done', 'failed')
+    ) if os.path.isdir(config.DIR_INGEST) else []
+    if not batches:
+        return 0
+
+    lock = os.path.join(config.DIR_INGEST, '.lock')
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        # another process is ingesting, take over if it died
+        if time.time() - os.path.getmtime(lock) > config.INGEST_LOCK_TIMEOUT:
+            os.remove(lock)
+        return 0
+
+    try:
+        store = data.load_store()
+        cube = data.load_cube(store)
+
+        ingested = 0
+        for batch in batches:
+            try:
+                store, cube = data.ingest(store, cube, *read_batch(batch))
+            except Exception:
+                logger.exception('ingesting %s failed', batch)
+                _move(batch, 'failed')
+                continue
+
+            _move(batch, 'done')
+            ingested += 1
+
+        if ingested:
+            data.save_dataset(store, cube)
+
+        return ingested
+    finally:
+        os.remove(lock)
+
+
+def read_batch(path):
+    '''order, order_item, order_payment, order_review and customer (None when absent) tables of a queued batch.
+    '''
+    tables = []
+    for name in ('order', 'order_item', 'order_payment', 'order_review', 'customer'):
+        filename = os.path.join(path, config.DATA_FILES[name])
+        tables.append(pd.read_csv(filename) if name != 'customer' or os.path.exists(filename) else None)
+
+    return tables
+
+
+def _move(batch, status):
+    os.makedirs(os.path.join(config.DIR_INGEST, status), exist_ok=True)
+    shutil.move(batch, os.path.join(config.DIR_INGEST, status, os.path.basename(batch)))
@@ -0,0 +1,300 @@
+import collections
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+from . import config
+
+# name, type and help of the metrics, exposed with the config.METRICS_PREFIX prefix
+METRICS = {
+    'stage_seconds': ('summary', 'time spent in each stage of the callbacks'),
+    'rows_scanned_total': ('counter', 'rows or cube cells scanned by each stage'),
+    'result_size': ('summary', 'size of the results of each stage: rows, values or bytes'),
+    'cache_requests_total': ('counter', 'lookups of the caches by result'),
+    'requests_total': ('counter', 'requests served by endpoint and status'),
+    'jobs_total': ('counter', 'background jobs of the panels submitted and cancelled'),
+}
+
+
+class Registry:
+    '''counters and summaries (count and sum) by name and labels, rendered in the Prometheus text format.
+
+    Collectors are functions called on rendering that give (name, labels, value) of counters kept elsewhere.
+    '''
+
+    def __init__(self):
+        self._values = collections.defaultdict(float)
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] += value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[(f'{name}_count', key)] += 1
+            self._values[(f'{name}_sum', key)] += value
+
+    def collector(self, function):
+        self._collectors.append(function)
+        return function
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        for function in self._collectors:
+            values.extend(((name, tuple(sorted(labels.items()))), value) for name, labels, value in function())
+
+        samples = collections.defaultdict(list)
+        for (name, labels), value in sorted(values):
+            metric = name if name in METRICS else name.rsplit('_', 1)[0]
+            samples[metric].append((name, labels, value))
+
+        lines = []
+        for metric, metric_samples in samples.items():
+            kind, description = METRICS[metric]
+            lines.append(f'# HELP {config.METRICS_PREFIX}{metric} {description}')
+            lines.append(f'# TYPE {config.METRICS_PREFIX}{metric} {kind}')
+            for name, labels, value in metric_samples:
+                labels = ','.join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f'{config.METRICS_PREFIX}{name}{{{labels}}} {value:.9g}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+_local = threading.local()
+
+
+class Stage:
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+        self.children = 0.
+        self.rows = 0
+
+
+@contextlib.contextmanager
+def stage(name, function, exclusive=False):
+    '''time a stage of the current request, exclusive stages do not count the time of the stages they contain.
+    '''
+    stack = _stack()
+    current = Stage(name, function)
+    stack.append(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+
+        duration = elapsed - current.children if exclusive else elapsed
+        registry.observe('stage_seconds', duration, stage=name, function=function)
+        if current.rows:
+            registry.increment('rows_scanned_total', current.rows, stage=name, function=function)
+
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings[(name, function)] += duration
+
+
+def timed(name, rows=None, exclusive=False):
+    '''time the calls of a function as a stage, with the size of its result and the size of its positional argument
+    rows as rows scanned.
+    '''
+    def decorator(function):
+        label = function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name, label, exclusive) as current:
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    current.rows += size(args[rows]) or 0
+
+            result_size = size(result)
+            if result_size is not None:
+                registry.observe('result_size', result_size, stage=name, function=label)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def scanned(rows):
+    '''add rows to the rows scanned by the current stage.
+    '''
+    stack = _stack()
+    if stack:
+        stack[-1].rows += rows
+
+
+def cache_request(cache, hit):
+    registry.increment('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+def job(slot, event):
+    registry.increment('jobs_total', slot=slot, event=event)
+
+
+def lru_cache_collector(caches):
+    '''collect the hits and misses of functools.lru_cache functions given by name.
+    '''
+    @registry.collector
+    def collect():
+        for name, function in caches.items():
+            info = function.cache_info()
+            yield 'cache_requests_total', {'cache': name, 'result': 'hit'}, info.hits
+            yield 'cache_requests_total', {'cache': name, 'result': 'miss'}, info.misses
+
+    return collect
+
+
+def size(value):
+    # rows of frames and arrays, length of strings and sequences, None for scalars and slices without a stop
+    if isinstance(value, slice):
+        return None if value.stop is None else len(range(*value.indices(value.stop)))
+    if isinstance(value, tuple):
+        sizes = [size(item) for item in value]
+        return sum(item for item in sizes if item is not None)
+    if hasattr(value, '__len__'):
+        return len(value)
+
+    return None
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    return _local.stack
+
+
+class Sampler:
+    '''sampling profiler of one thread: its stack is read every interval seconds from another thread and counted in
+    the collapsed format of flame graphs (one line per stack, frames from the root separated by ;).
+    '''
+
+    def __init__(self, ident, interval=None):
+        self.ident = ident
+        self.interval = interval or config.PROFILER_INTERVAL
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+_traffic_lock = threading.Lock()
+
+
+def _log_traffic(request, response):
+    # one file per process so that the lines of several workers never interleave, clients told apart by address and
+    # user agent
+    client = hashlib.sha1(f'{request.remote_addr} {request.user_agent}'.encode()).hexdigest()[:16]
+    record = {
+        'time': time.time(),
+        'client': client,
+        'status': response.status_code,
+        'body': request.get_json(silent=True),
+    }
+
+    os.makedirs(config.DIR_TRAFFIC, exist_ok=True)
+    with _traffic_lock, open(os.path.join(config.DIR_TRAFFIC, f'{os.getpid()}.jsonl'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def init_app(server):
+    '''record the stages of every request of a Flask server, report them in its Server-Timing header and serve the
+    metrics on /metrics.
+
+    When config.PROFILER is set, a request with the X-Profile header or the profile cookie is sampled and its
+    profile saved to config.DIR_PROFILES, named in the X-Profile response header. When config.TRAFFIC_LOG is set,
+    the callback requests are logged to config.DIR_TRAFFIC to be replayed by benchmarks.load_test.
+    '''
+    import flask
+
+    @server.before_request
+    def start_request():
+        _local.timings = collections.defaultdict(float)
+        _local.start = time.perf_counter()
+        _local.sampler = None
+        if config.PROFILER and (flask.request.headers.get('X-Profile') or flask.request.cookies.get('profile')):
+            _local.sampler = Sampler(threading.get_ident()).start()
+
+    @server.after_request
+    def finish_request(response):
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return response
+
+        entries = [
+            f'{name};desc="{function}";dur={1000 * duration:.2f}' for (name, function), duration in timings.items()
+        ]
+        entries.append(f'total;dur={1000 * (time.perf_counter() - _local.start):.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+        registry.increment('requests_total', endpoint=flask.request.endpoint or 'none', status=response.status_code)
+
+        if _local.sampler is not None:
+            sampler, _local.sampler = _local.sampler, None
+            sampler.stop()
+            endpoint = re.sub(r'\W+', '_', flask.request.path).strip('_')
+            filename = f'{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}-{endpoint}.txt'
+            sampler.save(os.path.join(config.DIR_PROFILES, filename))
+            response.headers['X-Profile'] = filename
+
+        if config.TRAFFIC_LOG and flask.request.path == '/_dash-update-component':
+            _log_traffic(flask.request, response)
+
+        return response
+
+    @server.teardown_request
+    def end_request(exception=None):
+        _local.timings = None
+        sampler, _local.sampler = getattr(_local, 'sampler', None), None
+        if sampler is not None:
+            sampler.stop()
+
+    @server.route('/metrics')
+    def serve_metrics():
+        return flask.Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return server
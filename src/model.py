@@ -1,7 +1,22 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 from statsmodels.tsa.arima_model import ARIMA
 
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# two-sided 95% normal quantile, as used by statsmodels forecast intervals
+_Z_95 = 1.959963984540054
+
 
 def predict(dates, x, look_ahead):
     
@@ -9,7 +24,7 @@ def predict(dates, x, look_ahead):
     forecast_end_date = (forecast_start_date + pd.DateOffset(look_ahead - 1)).date()
     forecast_end = 15 + x.shape[0] - 1
     
-    model = ARIMA(x, order=(9,0,1))
+    model = ARIMA(x, order=config.FORECAST_ORDER)
     model_fit = model.fit(method='css') # conditional sum of squares likelihood is maximized, faster as no Kalmann filter needs to be designed and the full maximum likehood is not computed
     
     predictions, stderr, ci = model_fit.forecast(look_ahead)
@@ -22,4 +37,285 @@ def predict(dates, x, look_ahead):
         'stderr': stderr
     })
     
-    return predictions
\ No newline at end of file
+    return predictions
+
+
+def fingerprint(dates, x, look_ahead):
+    '''key of a forecast: digest of the daily series it is fitted on and of the model settings.
+    '''
+    digest = hashlib.sha1()
+    digest.update(np.asarray(dates, dtype='datetime64[D]').astype(np.int64).tobytes())
+    digest.update(np.asarray(x, dtype=np.float64).tobytes())
+    digest.update(repr((config.FORECAST_ORDER, look_ahead)).encode())
+
+    return digest.hexdigest()
+
+
+def forecast_filename(key):
+    return os.path.join(config.DIR_FORECAST, f'{key}.csv')
+
+
+def load_forecast(key):
+    filename = forecast_filename(key)
+    if not os.path.exists(filename):
+        return None
+
+    return pd.read_csv(filename, parse_dates=['date'])
+
+
+def save_forecast(key, predictions):
+    # write then rename so that readers never see a partial file
+    filename = forecast_filename(key)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    predictions.to_csv(f'{filename}.tmp', index=False)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def cached_predict(dates, x, look_ahead):
+    '''forecast persisted on disk under the fingerprint of its input, fitted when missing.
+
+    When several processes need the same missing forecast, the first one to create the lock file fits it and the
+    others wait for the result.
+    '''
+    key = fingerprint(dates, x, look_ahead)
+    lock = f'{forecast_filename(key)}.lock'
+    os.makedirs(config.DIR_FORECAST, exist_ok=True)
+
+    while True:
+        predictions = load_forecast(key)
+        if predictions is not None:
+            return predictions
+
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            # another process is fitting, take over if it died
+            if time.time() - os.path.getmtime(lock) > config.FORECAST_LOCK_TIMEOUT:
+                os.remove(lock)
+            time.sleep(1)
+            continue
+
+        try:
+            predictions = predict(dates, x, look_ahead)
+            save_forecast(key, predictions)
+            return predictions
+        finally:
+            os.remove(lock)
+
+
+# result of the fits that failed, memoized for a shorter time than the forecasts
+_FAILED = object()
+
+
+class ForecastService:
+    '''fits forecasts in a thread pool and memoizes them in a bounded LRU whose entries expire after ttl seconds.
+
+    get never blocks: it schedules the fit of a key on its first request and reports whether the fit is done with
+    its result. Series shorter than config.FORECAST_MIN_DAYS and failed fits are memoized as None, failed fits are
+    logged and only kept for config.FORECAST_FAILURE_TTL seconds.
+    '''
+
+    def __init__(self, max_size=None, ttl=None, max_workers=None):
+        self.max_size = max_size or config.FORECAST_CACHE_SIZE
+        self.ttl = ttl or config.FORECAST_CACHE_TTL
+        self._executor = ThreadPoolExecutor(max_workers or config.FORECAST_WORKERS)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, dates, x, persist=False):
+        '''(done, forecast) of the series x memoized under key, persisted on disk as well when persist is set.
+        '''
+        with self._lock:
+            future = self._future(key)
+            if future is None:
+                future = self._executor.submit(self._fit, dates, x, persist)
+                self._cache[key] = (time.time(), future)
+                while len(self._cache) > self.max_size:
+                    _, (_, evicted) = self._cache.popitem(last=False)
+                    evicted.cancel()
+
+        if not future.done():
+            return False, None
+
+        result = future.result()
+        return True, None if result is _FAILED else result
+
+    def _future(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+
+        created, future = entry
+        failed = future.done() and not future.cancelled() and future.result() is _FAILED
+        if time.time() - created > (config.FORECAST_FAILURE_TTL if failed else self.ttl):
+            del self._cache[key]
+            return None
+
+        self._cache.move_to_end(key)
+        return future
+
+    @staticmethod
+    def _fit(dates, x, persist):
+        if len(x) < config.FORECAST_MIN_DAYS:
+            return None
+
+        try:
+            if persist:
+                return cached_predict(dates, x, config.FORECAST_LOOK_AHEAD)
+            return predict(dates, x, config.FORECAST_LOOK_AHEAD)
+        except Exception:
+            logger.exception('fitting a forecast of %d days failed', len(x))
+            return _FAILED
+
+
+def fit_ar(x, p):
+    '''least squares AR(p) with intercept fitted on every row of x at once.
+
+    Returns the coefficients, one row [intercept, a_1, ..., a_p] per series, and the residual variances.
+    '''
+    n_series, n_days = x.shape
+    n = n_days - p
+
+    design = np.ones((n_series, n, p + 1))
+    for lag in range(1, p + 1):
+        design[:, :, lag] = x[:, p - lag:n_days - lag]
+    y = x[:, p:]
+
+    # normal equations of all series solved in one batch, a small ridge keeps constant series solvable
+    gram = design.transpose(0, 2, 1) @ design
+    gram += np.eye(p + 1) * (1e-8 * np.trace(gram, axis1=1, axis2=2)[:, None, None] / (p + 1) + 1e-12)
+    coefficients = np.linalg.solve(gram, design.transpose(0, 2, 1) @ y[..., None])[..., 0]
+
+    residuals = y - (design @ coefficients[..., None])[..., 0]
+    variances = (residuals ** 2).mean(axis=1)
+
+    return coefficients, variances
+
+
+def forecast_ar(x, coefficients, variances, look_ahead):
+    '''forecasts and their standard errors for the next look_ahead days of every series of x.
+    '''
+    n_series, p = coefficients.shape[0], coefficients.shape[1] - 1
+    history = x[:, -p:][:, ::-1].copy()
+
+    forecasts = np.empty((n_series, look_ahead))
+    for h in range(look_ahead):
+        forecasts[:, h] = coefficients[:, 0] + (coefficients[:, 1:] * history).sum(axis=1)
+        history = np.concatenate([forecasts[:, h:h + 1], history[:, :-1]], axis=1)
+
+    # moving average representation of the AR process for the forecast errors
+    psi = np.zeros((n_series, look_ahead))
+    psi[:, 0] = 1.
+    for h in range(1, look_ahead):
+        lags = min(h, p)
+        psi[:, h] = (coefficients[:, 1:lags + 1] * psi[:, h - 1::-1][:, :lags]).sum(axis=1)
+
+    return forecasts, np.sqrt(variances[:, None] * np.cumsum(psi ** 2, axis=1))
+
+
+def _predict_batch_ls(x, look_ahead):
+    coefficients, variances = fit_ar(x, config.FORECAST_BATCH_AR_ORDER)
+    return forecast_ar(x, coefficients, variances, look_ahead)
+
+
+def _predict_batch_css(x, look_ahead):
+    dates = pd.Series(pd.date_range('1970-01-01', periods=x.shape[1], freq='1D'))
+    forecasts = np.full((len(x), look_ahead), np.nan)
+    stderr = np.full((len(x), look_ahead), np.nan)
+
+    for i, values in enumerate(x):
+        try:
+            predictions = predict(dates, pd.Series(values), look_ahead)
+        except Exception:
+            continue
+        forecasts[i], stderr[i] = predictions['forecast'], predictions['stderr']
+
+    return forecasts, stderr
+
+
+def predict_batch(dates, x, look_ahead, method=None, processes=None):
+    '''forecast every row of x, daily series over dates, with the least squares AR ('ls') or statsmodels ARIMA
+    ('css') estimator. Series are split across a process pool.
+
+    Returns a long DataFrame with the row of the series, the date, the forecast, its 95% confidence interval and
+    standard error. Series the estimator fails on have missing forecasts.
+    '''
+    method = method or config.FORECAST_BATCH_METHOD
+    processes = processes or config.FORECAST_BATCH_PROCESSES
+    predict_chunk = {'ls': _predict_batch_ls, 'css': _predict_batch_css}[method]
+
+    chunks = [chunk for chunk in np.array_split(np.asarray(x, dtype=np.float64), processes) if len(chunk)]
+    if len(chunks) > 1:
+        with ProcessPoolExecutor(len(chunks)) as executor:
+            results = list(executor.map(predict_chunk, chunks, [look_ahead] * len(chunks)))
+    else:
+        results = [predict_chunk(chunk, look_ahead) for chunk in chunks]
+
+    forecasts = np.concatenate([r[0] for r in results]) if results else np.empty((0, look_ahead))
+    stderr = np.concatenate([r[1] for r in results]) if results else np.empty((0, look_ahead))
+    forecast_dates = np.asarray(dates, dtype='datetime64[D]').max() + np.arange(1, look_ahead + 1)
+
+    return pd.DataFrame({
+        'series': np.repeat(np.arange(len(forecasts)), look_ahead),
+        'date': np.tile(forecast_dates, len(forecasts)).astype('datetime64[ns]'),
+        'forecast': forecasts.ravel(),
+        'ci_low': (forecasts - _Z_95 * stderr).ravel(),
+        'ci_high': (forecasts + _Z_95 * stderr).ravel(),
+        'stderr': stderr.ravel(),
+    })
+
+
+def batch_forecast_filename(version, method):
+    digest = hashlib.sha1(repr((version, method, config.FORECAST_BATCH_BY, config.FORECAST_BATCH_AR_ORDER,
+                                config.FORECAST_ORDER, config.FORECAST_LOOK_AHEAD)).encode()).hexdigest()
+    return os.path.join(config.DIR_FORECAST, f'batch_{digest}.csv')
+
+
+def build_batch_forecast(store, cube, method=None, processes=None):
+    '''forecast the daily revenue of every combination of config.FORECAST_BATCH_BY and save them in one table.
+    '''
+    method = method or config.FORECAST_BATCH_METHOD
+    df_series, dates, x = cube.daily_sales_by(np.arange(len(cube)), config.FORECAST_BATCH_BY)
+
+    predictions = predict_batch(dates, x, config.FORECAST_LOOK_AHEAD, method, processes)
+    predictions = df_series.iloc[predictions.pop('series')].reset_index(drop=True).join(predictions)
+
+    filename = batch_forecast_filename(store.version, method)
+    os.makedirs(config.DIR_FORECAST, exist_ok=True)
+    predictions.to_csv(f'{filename}.tmp', index=False)
+    os.replace(f'{filename}.tmp', filename)
+
+    return predictions
+
+
+def load_batch_forecast(store, method=None):
+    '''batch forecasts of the store indexed by config.FORECAST_BATCH_BY, None when they were not built.
+    '''
+    filename = batch_forecast_filename(store.version, method or config.FORECAST_BATCH_METHOD)
+    if not os.path.exists(filename):
+        return None
+
+    predictions = pd.read_csv(filename, parse_dates=['date'])
+    return predictions.set_index(config.FORECAST_BATCH_BY).sort_index()
+
+
+if __name__ == '__main__':
+    # precompute the forecasts of the processed dataset: python -m src.model [--batch [--method ls|css]]
+    import argparse
+
+    from . import data
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', action='store_true', help='forecast every state x product category')
+    parser.add_argument('--method', choices=['ls', 'css'], default=config.FORECAST_BATCH_METHOD)
+    parser.add_argument('--processes', type=int, default=config.FORECAST_BATCH_PROCESSES)
+    args = parser.parse_args()
+
+    store = data.load_store()
+    cube = data.load_cube(store)
+
+    if args.batch:
+        build_batch_forecast(store, cube, args.method, args.processes)
+    else:
+        dff = cube.daily_sales(np.arange(len(cube)))
+        cached_predict(dff['order_purchase_timestamp'], dff['payment_value'], config.FORECAST_LOOK_AHEAD)
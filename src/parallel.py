@@ -0,0 +1,97 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import config, jobs
+
+_local = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def _executor():
+    # shared by every request of the process, config.AGGREGATE_WORKERS bounds the cores used by all the queries
+    return ThreadPoolExecutor(config.AGGREGATE_WORKERS, thread_name_prefix='aggregate')
+
+
+def partitions(n_rows):
+    '''bounds of the partitions of n_rows rows: one per worker, none smaller than config.AGGREGATE_PARTITION_ROWS.
+    '''
+    n_partitions = max(1, min(config.AGGREGATE_WORKERS, n_rows // config.AGGREGATE_PARTITION_ROWS))
+    bounds = np.linspace(0, n_rows, n_partitions + 1).astype(np.int64)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def map_reduce(partial, merge, rows, *arrays):
+    '''merge of the partial aggregates of the partitions of rows, computed in parallel.
+
+    rows is an index array or a slice with a stop (and no step), arrays hold one value per row (or are None) and are
+    split along. partial is called with the rows and arrays of one partition, merge with the list of the partial
+    aggregates. Small inputs, and calls from a partial, run in the calling thread.
+    '''
+    if isinstance(rows, slice):
+        if rows.stop is None or rows.step not in (None, 1):
+            raise ValueError(f'rows must be an index array or a slice with a stop and no step, not {rows}')
+        rows = slice(rows.start or 0, rows.stop)
+
+    n_rows = rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+    bounds = partitions(n_rows)
+    if len(bounds) == 1 or getattr(_local, 'worker', False):
+        return merge([partial(rows, *arrays)])
+
+    jobs.checkpoint()
+    results = list(_executor().map(lambda bound: _partial(partial, bound, rows, arrays), bounds))
+
+    return merge(results)
+
+
+def _partial(partial, bound, rows, arrays):
+    first, last = bound
+    if isinstance(rows, slice):
+        rows = slice(rows.start + first, rows.start + last)
+    else:
+        rows = rows[first:last]
+
+    _local.worker = True
+    try:
+        return partial(rows, *[None if values is None else values[first:last] for values in arrays])
+    finally:
+        _local.worker = False
+
+
+# merges of the partial aggregates
+def add(partials):
+    '''sums and counts.
+    '''
+    return functools.reduce(np.add, partials)
+
+
+def maximum(partials):
+    '''HyperLogLog sketches, the maximum rank of each register.
+    '''
+    return functools.reduce(np.maximum, partials)
+
+
+def logical_or(partials):
+    '''masks of the distinct values present.
+    '''
+    return functools.reduce(np.logical_or, partials)
+
+
+def union(partials):
+    '''sorted arrays of distinct keys, sorted and distinct in the result as well.
+    '''
+    if len(partials) == 1:
+        return partials[0]
+
+    # stable sort merges the sorted runs instead of sorting from scratch
+    keys = np.sort(np.concatenate(partials), kind='mergesort')
+    return keys[np.append(True, keys[1:] != keys[:-1])] if len(keys) else keys
+
+
+def concatenate(partials):
+    '''values of each row.
+    '''
+    return partials[0] if len(partials) == 1 else np.concatenate(partials)
@@ -1,23 +1,152 @@
+import base64
+import functools
+
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-from . import config
+from . import config, metrics
+
+_DAY_MS = 24 * 3600 * 1000
+
+
+def lttb(x, y, n_out):
+    '''indices of the n_out points kept by Largest-Triangle-Three-Buckets downsampling, first and last included.
+
+    The points between the first and the last are split in n_out - 2 buckets, each keeps the point forming the
+    largest triangle with the point kept in the previous bucket and the mean of the next one.
+    '''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    index = np.zeros(n_out, dtype=np.int64)
+    index[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[stop:edges[i + 2]].mean(), y[stop:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        area = np.abs((x[a] - next_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        index[i + 1] = a
+
+    return index
+
+
+def downsample(dates, values, first=None, last=None):
+    '''positions of the points of a daily series kept to draw it on a graph whose x axis spans from first to last
+    (its own dates by default), None when all of them are.
+
+    The series keeps config.PLOT_POINTS_PER_PIXEL points per pixel of the part of the config.PLOT_WIDTH pixels of the
+    axis its dates cover, chosen by LTTB on values. Traces sharing the x axis are indexed with the same positions so
+    that their points stay aligned.
+    '''
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    if len(dates) < 3:
+        return None
+
+    first = dates[0] if first is None else min(dates[0], np.datetime64(first, 'ns'))
+    last = dates[-1] if last is None else max(dates[-1], np.datetime64(last, 'ns'))
+    width = config.PLOT_WIDTH * ((dates[-1] - dates[0]) / max(last - first, np.timedelta64(1, 'D')))
+    n_out = int(width * config.PLOT_POINTS_PER_PIXEL)
+    if len(dates) <= n_out:
+        return None
+
+    return lttb(dates.astype(np.int64) / 8.64e13, np.asarray(values, dtype=np.float64), max(n_out, 3))
+
+
+def _daily(dates, values, decimals=None, index=None):
+    # coordinates of a daily series: its points at the positions index when downsampled, else a start and a step of
+    # one day instead of every date
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    values = np.asarray(values, dtype=np.float64)
+    if decimals is not None:
+        values = np.round(values, decimals)
+
+    if index is not None:
+        return dict(x=_dates(dates[index]), y=values[index])
+
+    if len(dates) > 1 and (np.diff(dates) == np.timedelta64(1, 'D')).all():
+        return dict(x0=str(dates[0].astype('datetime64[D]')), dx=_DAY_MS, y=values)
+
+    return dict(x=_dates(dates), y=values)
+
+
+def _dates(dates):
+    # ISO strings, numpy dates are not serialized as such outside of plotly figures
+    return np.datetime_as_string(np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[s]'))
+
+
+def _typed_arrays(trace):
+    # numeric arrays of a trace as base64 typed arrays of 32 bits values, nested attributes (marker...) included
+    for key, value in trace.items():
+        if isinstance(value, dict):
+            _typed_arrays(value)
+        elif isinstance(value, (list, tuple, np.ndarray)) and len(value):
+            array = np.asarray(value)
+            if array.dtype.kind in 'iuf':
+                dtype = 'f4' if array.dtype.kind == 'f' else 'i4'
+                trace[key] = {'dtype': dtype, 'bdata': base64.b64encode(array.astype(f'<{dtype}').tobytes()).decode()}
+
+
+def _finalize(traces):
+    if config.PLOT_TYPED_ARRAYS:
+        for trace in traces:
+            _typed_arrays(trace)
+
+    return traces
+
+
+# Figures are split in a template, the static layout and the style of each trace by role, built once per process,
+# and the data of their traces, computed on every callback. The application ships the templates with the page and
+# only the data from the callbacks, the figure is assembled in the browser by assets/figures.js as assemble does.
+def _template(fig, roles):
+    fig = fig.to_plotly_json()
+    return {'layout': fig['layout'], 'traces': dict(zip(roles, fig['data']))}
+
+
+def _merge(style, trace):
+    merged = dict(style)
+    for key, value in trace.items():
+        if isinstance(value, dict) and isinstance(style.get(key), dict):
+            value = _merge(style[key], value)
+        merged[key] = value
+
+    return merged
+
+
+def assemble(template, traces):
+    '''figure made of a template and the data of its traces, each trace takes the style of its role.
+    '''
+    return {
+        'data': [
+            _merge(template['traces'][trace['role']], {k: v for k, v in trace.items() if k != 'role'})
+            for trace in traces
+        ],
+        'layout': template['layout'],
+    }
 
 
 # TODO moving average as principal line
-def sales_timeserie(df, predictions, plot_predictions=False):
-    df_rolling_mean = df.set_index('order_purchase_timestamp')[['payment_value', 'order_id']].rolling(
-        30).mean().dropna().reset_index()
-    df_rolling_mean = df_rolling_mean.round(2)
-    df = df.round(2)
+def sales_timeserie(df, predictions, plot_predictions=False, df_rolling_mean=None):
+    return assemble(sales_timeserie_template(), sales_timeserie_data(df, predictions, plot_predictions,
+                                                                     df_rolling_mean))
 
+
+@functools.lru_cache(maxsize=None)
+def sales_timeserie_template():
     fig = make_subplots(specs=[[{'secondary_y': True}]])
 
     fig.add_trace(
         go.Bar(
-            x=df['order_purchase_timestamp'], y=df['order_id'],
             name='Orders',
             marker_color='lightslategray',
             marker_opacity=.3,
@@ -27,53 +156,47 @@ def sales_timeserie(df, predictions, plot_predictions=False):
 
     fig.add_trace(
         go.Scatter(
-            x=df['order_purchase_timestamp'], y=df['payment_value'],
             mode='lines',
             marker_opacity=.3,
             name='Revenue'
         ),
         secondary_y=False,
     )
-    
-    if plot_predictions:
-        fig.add_trace(
-            go.Scatter(
-                x=predictions['date'], y=predictions['ci_high'],
-                mode='lines',
-                fill=None,
-                line_width=0,
-                name='Forecast 95% CI',
-                showlegend=False,
-            ),
-            secondary_y=False,
-        )
-        fig.add_trace(
-            go.Scatter(
-                x=predictions['date'], y=predictions['ci_low'],
-                mode='lines',
-                fill='tonexty',
-                fillcolor='rgba(173,216,230,0.2)',
-                line_width=0,
-                name='Forecast 95% CI',
-                showlegend=False,
-            ),
-            secondary_y=False,
-        )
-        fig.add_trace(
-            go.Scatter(
-                x=predictions['date'], y=predictions['forecast'],
-                mode='lines',
-                line_color='#add8e6',
-                line_dash='dot',
-                marker_opacity=.5,
-                name='15 days forecast'
-            ),
-            secondary_y=False,
-        )
-        
+
+    fig.add_trace(
+        go.Scatter(
+            mode='lines',
+            fill=None,
+            line_width=0,
+            name='Forecast 95% CI',
+            showlegend=False,
+        ),
+        secondary_y=False,
+    )
+    fig.add_trace(
+        go.Scatter(
+            mode='lines',
+            fill='tonexty',
+            fillcolor='rgba(173,216,230,0.2)',
+            line_width=0,
+            name='Forecast 95% CI',
+            showlegend=False,
+        ),
+        secondary_y=False,
+    )
+    fig.add_trace(
+        go.Scatter(
+            mode='lines',
+            line_color='#add8e6',
+            line_dash='dot',
+            marker_opacity=.5,
+            name='15 days forecast'
+        ),
+        secondary_y=False,
+    )
+
     fig.add_trace(
         go.Scatter(
-            x=df_rolling_mean['order_purchase_timestamp'], y=df_rolling_mean['payment_value'],
             mode='lines',
             line_width=4,
             name='Moving mean (30 days)'
@@ -97,11 +220,47 @@ def sales_timeserie(df, predictions, plot_predictions=False):
     fig.update_yaxes(title_text='Revenue', secondary_y=False)
     fig.update_yaxes(title_text='Orders', secondary_y=True)
 
-    return fig
+    return _template(fig, ['orders', 'revenue', 'ci_high', 'ci_low', 'forecast', 'moving_mean'])
+
+
+@metrics.timed('figure')
+def sales_timeserie_data(df, predictions, plot_predictions=False, df_rolling_mean=None):
+    if df_rolling_mean is None:
+        df_rolling_mean = df.set_index('order_purchase_timestamp')[['payment_value', 'order_id']].rolling(
+            30).mean().dropna().reset_index()
+
+    # the points kept of the revenue, on an axis extended by the forecast, are kept on every trace for the unified
+    # hover
+    dates = np.asarray(df['order_purchase_timestamp'], dtype='datetime64[ns]')
+    last = np.max(predictions['date'].values) if plot_predictions else None
+    index = downsample(dates, df['payment_value'], last=last)
+    rolling_dates = np.asarray(df_rolling_mean['order_purchase_timestamp'], dtype='datetime64[ns]')
+    rolling_index = None if index is None else np.flatnonzero(np.isin(rolling_dates, dates[index]))
+
+    traces = [
+        dict(role='orders', **_daily(dates, df['order_id'], 2, index)),
+        dict(role='revenue', **_daily(dates, df['payment_value'], 2, index)),
+    ]
+
+    if plot_predictions:
+        dates = _dates(predictions['date'])
+        for role in ('ci_high', 'ci_low', 'forecast'):
+            traces.append(dict(role=role, x=dates, y=predictions[role].values))
+
+    traces.append(
+        dict(role='moving_mean', **_daily(rolling_dates, df_rolling_mean['payment_value'], 2, rolling_index))
+    )
+
+    return _finalize(traces)
 
 
 # TODO orders on the map second
 def sales_map(df_map, df_time):
+    return assemble(sales_map_template(), sales_map_data(df_map, df_time))
+
+
+@functools.lru_cache(maxsize=None)
+def sales_map_template():
     fig = make_subplots(
         rows=1, cols=2,
         column_widths=[0.3, 0.6],
@@ -110,31 +269,20 @@ def sales_map(df_map, df_time):
 
     fig.add_trace(
         go.Scattergeo(
-            lat=df_map['lat'],
-            lon=df_map['long'],
-            text=df_map['text'],
             marker=dict(
-                size=df_map['payment_value'],
-                sizeref=df_map['payment_value'].min(),
                 sizemode='area',
-                color=df_map['state_name'].astype('category').cat.codes
             ),
             name='Map',
         ),
         row=1, col=1
     )
 
-    for s in df_time['state_name'].unique():
-        _df = df_time[df_time['state_name'] == s]
-
-        fig.add_trace(
-            go.Scatter(
-                x=_df['order_purchase_timestamp'], y=_df['payment_value'],
-                mode='markers',
-                marker_opacity=.6,
-                name=f'{s}',
-            ),
-        )
+    fig.add_trace(
+        go.Scatter(
+            mode='markers',
+            marker_opacity=.6,
+        ),
+    )
 
     fig.update_layout(
         showlegend=True,
@@ -159,13 +307,40 @@ def sales_map(df_map, df_time):
         paper_bgcolor='#F9F9F9',
     )
 
-    return fig
+    return _template(fig, ['map', 'state'])
+
+
+@metrics.timed('figure')
+def sales_map_data(df_map, df_time):
+    traces = [
+        dict(
+            role='map',
+            lat=df_map['lat'].values,
+            lon=df_map['long'].values,
+            text=df_map['text'].values,
+            marker=dict(
+                size=df_map['payment_value'].values,
+                sizeref=df_map['payment_value'].min(),
+                color=df_map['state_name'].astype('category').cat.codes.values
+            ),
+        )
+    ]
+
+    for s in df_time['state_name'].unique():
+        _df = df_time[df_time['state_name'] == s]
+        traces.append(dict(role='state', x=_dates(_df['order_purchase_timestamp']), y=_df['payment_value'].values,
+                           name=f'{s}'))
+
+    return _finalize(traces)
 
 
 # top sellers and number of sellers per month in a radarplot (sales)
 def sellers(df_seller_rank, df_seller_month):
-    df_seller_rank = df_seller_rank.sort_values('payment_value')
+    return assemble(sellers_template(), sellers_data(df_seller_rank, df_seller_month))
 
+
+@functools.lru_cache(maxsize=None)
+def sellers_template():
     fig = make_subplots(
         rows=1, cols=2,
         specs=[[{'type': 'bar'}, {'type': 'barpolar'}]],
@@ -173,11 +348,8 @@ def sellers(df_seller_rank, df_seller_month):
 
     fig.add_trace(
         go.Bar(
-            x=df_seller_rank['payment_value'].round(),
-            y=df_seller_rank['seller_id'],
             orientation='h',
             name='Revenues from top sellers',
-            text=df_seller_rank['payment_value'].round(),
             textposition='auto',
         ),
         row=1, col=1
@@ -185,8 +357,6 @@ def sellers(df_seller_rank, df_seller_month):
 
     fig.add_trace(
         go.Barpolar(
-            r=df_seller_month['seller_id'].round(),
-            theta=df_seller_month['month_name'],
             name='Number of sellers'
         ),
         row=1, col=2
@@ -194,8 +364,6 @@ def sellers(df_seller_rank, df_seller_month):
 
     fig.add_trace(
         go.Barpolar(
-            r=df_seller_month['payment_value'].round(2),
-            theta=df_seller_month['month_name'],
             name='Mean revenue per seller'
         ),
         row=1, col=2
@@ -215,4 +383,30 @@ def sellers(df_seller_rank, df_seller_month):
         paper_bgcolor='#F9F9F9',
     )
 
-    return fig
+    return _template(fig, ['top_sellers', 'n_sellers', 'mean_revenue'])
+
+
+@metrics.timed('figure')
+def sellers_data(df_seller_rank, df_seller_month):
+    df_seller_rank = df_seller_rank.sort_values('payment_value')
+
+    traces = [
+        dict(
+            role='top_sellers',
+            x=df_seller_rank['payment_value'].round().values,
+            y=df_seller_rank['seller_id'].values,
+            text=df_seller_rank['payment_value'].round().values,
+        ),
+        dict(
+            role='n_sellers',
+            r=df_seller_month['seller_id'].round().values,
+            theta=df_seller_month['month_name'].values,
+        ),
+        dict(
+            role='mean_revenue',
+            r=df_seller_month['payment_value'].round(2).values,
+            theta=df_seller_month['month_name'].values,
+        ),
+    ]
+
+    return _finalize(traces)
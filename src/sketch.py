@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+# bits of the hash used to compute the rank, enough for cardinalities far beyond the dataset
+_RANK_BITS = 32
+
+
+def precision(error):
+    '''smallest precision whose relative standard error (1.04 / sqrt(2^precision)) is below error.
+    '''
+    return int(np.clip(np.ceil(np.log2((1.04 / error) ** 2)), 7, 18))
+
+
+def hash_values(values):
+    '''64 bits hashes of integers (splitmix64 finalizer) or of any other values (pandas hashing).
+    '''
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.integer):
+        return pd.util.hash_array(values.astype(object))
+
+    h = values.astype(np.uint64)
+    with np.errstate(over='ignore'):
+        h = (h + np.uint64(0x9E3779B97F4A7C15))
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return h ^ (h >> np.uint64(31))
+
+
+def registers(hashes, p):
+    '''register index and rank (position of the first set bit) of each hash.
+    '''
+    register = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    bits = ((hashes >> np.uint64(64 - p - _RANK_BITS)) & np.uint64(2 ** _RANK_BITS - 1)).astype(np.float64)
+    # frexp gives the bit length of the exact float, 0 for 0
+    rank = _RANK_BITS + 1 - np.frexp(bits)[1]
+
+    return register, rank.astype(np.uint8)
+
+
+def estimate(sketches):
+    '''cardinality estimate of one sketch or of each row of a 2d array of sketches.
+
+    Uses the improved raw estimator of Ertl (2017) which stays unbiased from small to large cardinalities without
+    empirical bias correction.
+    '''
+    sketches = np.atleast_2d(sketches)
+    rows = np.repeat(np.arange(len(sketches)), sketches.shape[1])
+    histograms = np.bincount(rows * (_RANK_BITS + 2) + sketches.ravel(), minlength=len(sketches) * (_RANK_BITS + 2))
+
+    return _estimate(histograms.reshape(len(sketches), _RANK_BITS + 2), sketches.shape[1])
+
+
+def _estimate(histograms, m):
+    # estimates of every sketch at once from its number of registers of each rank, one row per sketch
+    histograms = histograms.astype(np.float64)
+    z = m * _tau(1. - histograms[:, _RANK_BITS + 1] / m)
+    for k in range(_RANK_BITS, 0, -1):
+        z = 0.5 * (z + histograms[:, k])
+    z += m * _sigma(histograms[:, 0] / m)
+
+    return m ** 2 / (2. * np.log(2.) * z)
+
+
+def _sigma(x):
+    # series iterated on every element until none changes, infinite for 1
+    full = x == 1.
+    x = np.where(full, 0., x)
+    y, z = 1., x
+    while True:
+        x = x * x
+        previous, z = z, z + x * y
+        y += y
+        if (z == previous).all():
+            return np.where(full, np.inf, z)
+
+
+def _tau(x):
+    # series iterated on every element until none changes, 0 for 0 and 1
+    edge = (x == 0.) | (x == 1.)
+    x = np.where(edge, 1., x)
+    y, z = 1., 1. - x
+    while True:
+        x = np.sqrt(x)
+        y *= 0.5
+        previous, z = z, z - (1. - x) ** 2 * y
+        if (z == previous).all():
+            return np.where(edge, 0., z / 3.)
+
+
+def merge(register, rank, p, by=None, n_groups=None):
+    '''sketch (or one sketch per group) holding the maximum rank seen by each register.
+    '''
+    if by is None:
+        sketches = np.zeros(2 ** p, dtype=np.uint8)
+        np.maximum.at(sketches, register, rank)
+    else:
+        sketches = np.zeros((n_groups, 2 ** p), dtype=np.uint8)
+        np.maximum.at(sketches, (by, register), rank)
+
+    return sketches
+
+
+def sparse(register, rank, p, by=None):
+    '''sparse sketch (or sketches per group) holding only the registers seen: sorted entries packing the group, the
+    register and its maximum rank as (group << p | register) << 6 | rank.
+
+    Unlike merge, its size does not grow with the number of groups times 2^p, many groups stay cheap.
+    '''
+    keys = register.astype(np.int64) if by is None else by.astype(np.int64) << p | register
+    return sparse_merge([keys << 6 | rank.astype(np.int64)])
+
+
+def sparse_merge(sketches):
+    '''sparse sketch of the maximum rank of each register of the given sparse sketches.
+    '''
+    entries = np.sort(np.concatenate(sketches))
+    keys = entries >> 6
+
+    return entries[np.append(keys[1:] != keys[:-1], True)] if len(entries) else entries
+
+
+def estimate_sparse(entries, p, n_groups=1):
+    '''cardinality estimate of each group of a sparse sketch.
+    '''
+    group, rank = entries >> (p + 6), entries & 63
+    histograms = np.bincount(group * (_RANK_BITS + 2) + rank, minlength=n_groups * (_RANK_BITS + 2)).reshape(
+        n_groups, _RANK_BITS + 2)
+    histograms[:, 0] += 2 ** p - histograms.sum(axis=1)
+
+    return _estimate(histograms, 2 ** p)
+
+
+def count_distinct(values, p, by=None, n_groups=None):
+    '''estimated number of distinct values, overall or per group id given in by.
+    '''
+    register, rank = registers(hash_values(values), p)
+    if by is None:
+        return int(np.rint(estimate(merge(register, rank, p))[0]))
+
+    return np.rint(estimate_sparse(sparse(register, rank, p, by), p, n_groups)).astype(np.int64)